@@ -1,11 +1,33 @@
 # The COPYRIGHT file at the top level of this repository contains the full
 # copyright notices and license terms.
 from trytond.pool import Pool
+from . import company
+from . import currency
+from . import period
 from . import stock
+from . import stock_reporting
 
 def register():
     Pool.register(
+        company.Company,
+        currency.CurrencyRate,
+        stock.AnalyticAccountEntry,
         stock.AnalyticLine,
+        stock.AnalyticLineStockMove,
         stock.Location,
+        stock.LocationAnalyticAccount,
+        stock.LocationCompany,
         stock.Move,
+        stock.RecomputeAnalyticLinesStart,
+        stock.RecomputeAnalyticLinesResult,
+        stock.PreviewAnalyticLinesResult,
+        stock.PreviewAnalyticLinesTotal,
+        period.Period,
+        period.PeriodAnalyticCache,
+        stock_reporting.AnalyticFlow,
+        stock_reporting.AnalyticFlowContext,
         module='analytic_stock', type_='model')
+    Pool.register(
+        stock.RecomputeAnalyticLines,
+        stock.PreviewAnalyticLines,
+        module='analytic_stock', type_='wizard')
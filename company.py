@@ -0,0 +1,26 @@
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+from trytond.model import fields
+from trytond.pool import PoolMeta
+
+__all__ = ['Company']
+
+
+class Company(metaclass=PoolMeta):
+    __name__ = 'company.company'
+    analytic_stock_posting = fields.Selection([
+            ('immediate', 'Immediate'),
+            ('deferred', 'Deferred'),
+            ], 'Analytic Stock Posting', required=True,
+        help='Immediate: the analytic lines of stock moves are created when '
+        'the moves are done.\n'
+        'Deferred: the done moves are queued and their analytic lines are '
+        'created later by the queue workers.')
+    analytic_stock_consolidate = fields.Boolean(
+        'Consolidate Analytic Stock Lines',
+        help='Create one analytic line by shipment, date and account instead '
+        'of one line by stock move.')
+
+    @staticmethod
+    def default_analytic_stock_posting():
+        return 'immediate'
@@ -0,0 +1,17 @@
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+from trytond.pool import PoolMeta
+
+from .memo import AnalyticMemo
+
+__all__ = ['CurrencyRate']
+
+
+class CurrencyRate(metaclass=PoolMeta):
+    __name__ = 'currency.currency.rate'
+
+    @classmethod
+    def on_modification(cls, mode, rates, field_names=None):
+        super(CurrencyRate, cls).on_modification(
+            mode, rates, field_names=field_names)
+        AnalyticMemo.invalidate_rates()
@@ -0,0 +1,103 @@
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+import csv
+import datetime
+from decimal import Decimal
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+__all__ = ['formats', 'writer']
+
+
+def formats():
+    '''
+    Return the available export formats.
+    '''
+    result = ['csv']
+    if pyarrow:
+        result.append('parquet')
+    return result
+
+
+def writer(format, file, columns):
+    '''
+    Return a writer of rows to file in format.
+    columns is a list of (name, type) where type is one of 'integer', 'char',
+    'numeric', 'date' and 'datetime'.
+    '''
+    if format == 'csv':
+        return CSVWriter(file, columns)
+    elif format == 'parquet':
+        if not pyarrow:
+            raise ImportError('pyarrow is required to export to parquet')
+        return ParquetWriter(file, columns)
+    raise ValueError('Unknown export format: %s' % format)
+
+
+class CSVWriter(object):
+    '''
+    Write rows to a text file as CSV with a header.
+    '''
+
+    def __init__(self, file, columns):
+        self._writer = csv.writer(file)
+        self._writer.writerow([n for n, _ in columns])
+
+    def write(self, rows):
+        self._writer.writerows(rows)
+
+    def close(self):
+        pass
+
+
+class ParquetWriter(object):
+    '''
+    Write rows to a binary file or path as Parquet with a row group by call.
+    '''
+
+    def __init__(self, file, columns):
+        self.columns = columns
+        self.schema = pyarrow.schema([
+                (n, self._type(t)) for n, t in columns])
+        self._writer = pyarrow.parquet.ParquetWriter(file, self.schema)
+
+    @staticmethod
+    def _type(type_):
+        return {
+            'integer': pyarrow.int64(),
+            'char': pyarrow.string(),
+            'numeric': pyarrow.decimal128(38, 10),
+            'date': pyarrow.date32(),
+            'datetime': pyarrow.timestamp('us'),
+            }[type_]
+
+    @staticmethod
+    def _convert(type_, value):
+        # some backends return strings or floats for computed columns
+        if value is None:
+            return value
+        if type_ == 'numeric' and not isinstance(value, Decimal):
+            return Decimal(str(value))
+        elif type_ == 'date' and isinstance(value, str):
+            return datetime.date.fromisoformat(value)
+        elif type_ == 'datetime' and isinstance(value, str):
+            return datetime.datetime.fromisoformat(value)
+        return value
+
+    def write(self, rows):
+        if not rows:
+            return
+        arrays = []
+        for i, (_, type_) in enumerate(self.columns):
+            arrays.append(pyarrow.array(
+                    [self._convert(type_, r[i]) for r in rows],
+                    type=self.schema.field(i).type))
+        self._writer.write_table(
+            pyarrow.Table.from_arrays(arrays, schema=self.schema))
+
+    def close(self):
+        self._writer.close()
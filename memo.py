@@ -0,0 +1,89 @@
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+from trytond.transaction import Transaction
+
+__all__ = ['AnalyticMemo']
+
+
+class AnalyticMemo(object):
+    '''
+    Memo of the currency rates and UoM conversions used to compute analytic
+    amounts.
+    It is joined to the transaction as a data manager so there is one memo
+    by transaction and it is cleared when the transaction ends.
+    '''
+
+    def __init__(self):
+        self.rates = {}
+        self.quantities = {}
+        self.hits = 0
+        self.misses = 0
+
+    def __eq__(self, other):
+        return isinstance(other, AnalyticMemo)
+
+    def __hash__(self):
+        return hash(AnalyticMemo)
+
+    @classmethod
+    def get(cls):
+        'Return the memo of the current transaction'
+        return Transaction().join(cls())
+
+    @classmethod
+    def invalidate_rates(cls):
+        'Clear the currency rates of the memo of the current transaction'
+        transaction = Transaction()
+        if transaction._datamanagers and cls() in transaction._datamanagers:
+            cls.get().rates.clear()
+
+    def _get(self, cache, key, compute):
+        try:
+            value = cache[key]
+        except KeyError:
+            self.misses += 1
+            value = cache[key] = compute()
+        else:
+            self.hits += 1
+        return value
+
+    def rate(self, from_currency, to_currency, date, compute):
+        '''
+        Return the rates of from_currency and to_currency at date, calling
+        compute if they are not memoized.
+        '''
+        return self._get(self.rates,
+            (int(from_currency), int(to_currency), date), compute)
+
+    def quantity(self, from_uom, to_uom, quantity, compute):
+        '''
+        Return quantity of from_uom converted to to_uom, calling compute if it
+        is not memoized.
+        '''
+        return self._get(self.quantities,
+            (int(from_uom), int(to_uom), quantity), compute)
+
+    @property
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.
+
+    def clear(self):
+        self.rates.clear()
+        self.quantities.clear()
+        self.hits = self.misses = 0
+
+    def tpc_begin(self, trans):
+        pass
+
+    def commit(self, trans):
+        pass
+
+    def tpc_vote(self, trans):
+        pass
+
+    def tpc_finish(self, trans):
+        self.clear()
+
+    def tpc_abort(self, trans):
+        self.clear()
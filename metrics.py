@@ -0,0 +1,167 @@
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+from trytond import backend, config
+from trytond.transaction import Transaction
+
+__all__ = ['QueryCounter', 'Registry', 'registry', 'enabled', 'measure']
+
+logger = logging.getLogger(__name__)
+
+# active counters by connection
+_counters = {}
+
+
+class QueryCounter(object):
+    '''
+    Context manager that counts the SQL queries executed on the connection
+    of the current transaction. Counters can be nested.
+    '''
+
+    def __init__(self):
+        self.count = 0
+        self._connection = None
+
+    def __enter__(self):
+        self._connection = connection = Transaction().connection
+        counters = _counters.get(id(connection))
+        if counters is None:
+            counters = _counters[id(connection)] = []
+            self._install(connection, counters)
+        counters.append(self)
+        return self
+
+    def __exit__(self, type, value, traceback):
+        connection = self._connection
+        counters = _counters[id(connection)]
+        counters.remove(self)
+        if not counters:
+            del _counters[id(connection)]
+            self._uninstall(connection, counters)
+        self._connection = None
+
+    @staticmethod
+    def _install(connection, counters):
+        def increment(*args):
+            for counter in counters:
+                counter.count += 1
+
+        if backend.name == 'sqlite':
+            connection.set_trace_callback(increment)
+        else:
+            factory = connection.cursor_factory
+
+            class CountingCursor(factory):
+                _factory = factory
+
+                def execute(self, *args, **kwargs):
+                    increment()
+                    return super().execute(*args, **kwargs)
+
+                def executemany(self, *args, **kwargs):
+                    increment()
+                    return super().executemany(*args, **kwargs)
+
+            connection.cursor_factory = CountingCursor
+
+    @staticmethod
+    def _uninstall(connection, counters):
+        if backend.name == 'sqlite':
+            sqlite_logger = logging.getLogger(
+                'trytond.backend.sqlite.database')
+            connection.set_trace_callback(sqlite_logger.debug
+                if sqlite_logger.isEnabledFor(logging.DEBUG) else None)
+        else:
+            connection.cursor_factory = connection.cursor_factory._factory
+
+
+class Registry(object):
+    '''
+    In-process registry of the metrics of each phase of the analytic
+    processing of moves.
+    '''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics = {}
+
+    def record(self, phase, moves=0, lines=0, queries=0, duration=0.,
+            hits=0, misses=0):
+        with self._lock:
+            metrics = self._metrics.setdefault(phase, {
+                    'calls': 0,
+                    'moves': 0,
+                    'lines': 0,
+                    'queries': 0,
+                    'time': 0.,
+                    'hits': 0,
+                    'misses': 0,
+                    })
+            metrics['calls'] += 1
+            metrics['moves'] += moves
+            metrics['lines'] += lines
+            metrics['queries'] += queries
+            metrics['time'] += duration
+            metrics['hits'] += hits
+            metrics['misses'] += misses
+
+    def snapshot(self):
+        with self._lock:
+            return {p: m.copy() for p, m in self._metrics.items()}
+
+    def reset(self):
+        with self._lock:
+            self._metrics.clear()
+
+
+registry = Registry()
+
+
+def enabled():
+    '''
+    Return if the metrics are enabled by the analytic_stock/metrics option.
+    The option is read on each call so it can be changed at runtime.
+    '''
+    return config.getboolean('analytic_stock', 'metrics', default=False)
+
+
+class _Measure(object):
+    __slots__ = ('moves', 'lines', 'hits', 'misses')
+
+    def __init__(self, moves=0, lines=0):
+        self.moves = moves
+        self.lines = lines
+        self.hits = 0
+        self.misses = 0
+
+
+@contextmanager
+def measure(phase, moves=0):
+    '''
+    Measure the time and the SQL queries of phase, record them in the
+    registry and log them.
+    The yielded object allows to set the number of moves and lines processed
+    and the hits and misses of the memo used.
+    '''
+    result = _Measure(moves=moves)
+    if not enabled():
+        yield result
+        return
+    start = time.perf_counter()
+    with QueryCounter() as counter:
+        yield result
+    duration = time.perf_counter() - start
+    registry.record(phase, moves=result.moves, lines=result.lines,
+        queries=counter.count, duration=duration,
+        hits=result.hits, misses=result.misses)
+    if result.hits or result.misses:
+        logger.info('%s: %s moves, %s lines, %s queries, %s/%s memo hits '
+            'in %.3fs', phase, result.moves, result.lines, counter.count,
+            result.hits, result.hits + result.misses, duration)
+    else:
+        logger.info('%s: %s moves, %s lines, %s queries in %.3fs',
+            phase, result.moves, result.lines, counter.count, duration)
@@ -0,0 +1,126 @@
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+import logging
+import multiprocessing
+import time
+from concurrent import futures
+
+from trytond import backend, config
+from trytond.pool import Pool
+from trytond.tools import grouped_slice
+from trytond.transaction import Transaction
+
+__all__ = ['run', 'run_chunks', 'max_processes']
+
+logger = logging.getLogger(__name__)
+
+
+def max_processes():
+    '''
+    Return the maximum number of processes allowed by the
+    analytic_stock/processes option (default: the number of CPUs).
+    '''
+    try:
+        default = multiprocessing.cpu_count()
+    except NotImplementedError:
+        default = 1
+    return config.getint('analytic_stock', 'processes', default=default)
+
+
+def run(model, method, ids, processes=None, chunk_size=None, **kwargs):
+    '''
+    Call the classmethod method of model on the records of ids split in
+    chunks of chunk_size, each chunk in its own transaction of a process
+    pool of at most processes.
+    The chunks are built from the sorted ids so a new run retries exactly the
+    same chunks.
+    Return the list of results and the list of (chunk ids, error) of the
+    chunks that failed.
+    The records must be committed as the workers use their own connections.
+    '''
+    if chunk_size is None:
+        chunk_size = config.getint('analytic_stock', 'parallel_chunk',
+            default=1000)
+    chunks = (list(c) for c in grouped_slice(sorted(set(ids)), chunk_size))
+    return run_chunks(model, method, chunks, processes=processes, **kwargs)
+
+
+def run_chunks(model, method, chunks, processes=None, **kwargs):
+    '''
+    Call the classmethod method of model on each chunk of record ids in its
+    own transaction of a process pool of at most processes.
+    The chunks are consumed only as the processes are available so they can
+    be generated lazily.
+    Return the list of results and the list of (chunk ids, error) of the
+    chunks that failed.
+    '''
+    transaction = Transaction()
+    processes = min(processes or max_processes(), max_processes())
+
+    context = transaction.context.copy()
+    context.pop('_check_access', None)
+    results, failures = [], []
+
+    def collect(future, chunk):
+        try:
+            results.append(future.result())
+        except Exception as exception:
+            logger.error('chunk %s-%s of %s.%s failed',
+                chunk[0], chunk[-1], model, method, exc_info=True)
+            failures.append((chunk, exception))
+
+    with futures.ProcessPoolExecutor(max_workers=processes,
+            mp_context=multiprocessing.get_context('spawn'),
+            initializer=_initializer,
+            initargs=(config.get('database', 'uri'),)) as executor:
+        pending = {}
+        for chunk in chunks:
+            if not chunk:
+                continue
+            # keep a bounded number of chunks queued
+            if len(pending) >= 2 * processes:
+                done, _ = futures.wait(pending,
+                    return_when=futures.FIRST_COMPLETED)
+                for future in done:
+                    collect(future, pending.pop(future))
+            future = executor.submit(_process, transaction.database.name,
+                transaction.user, context, model, method, chunk, kwargs)
+            pending[future] = chunk
+        for future in futures.as_completed(pending):
+            collect(future, pending[future])
+    return results, failures
+
+
+def _initializer(uri):
+    config.update_etc()
+    if uri and not config.has_section('database'):
+        config.add_section('database')
+    if uri:
+        config.set('database', 'uri', uri)
+
+
+def _process(database_name, user, context, model, method, ids, kwargs):
+    database_list = Pool.database_list()
+    pool = Pool(database_name)
+    if database_name not in database_list:
+        with Transaction().start(database_name, 0, readonly=True):
+            pool.init()
+
+    retry = config.getint('database', 'retry')
+    count = 0
+    while True:
+        if count:
+            time.sleep(0.02 * count)
+        with Transaction().start(database_name, user,
+                context=context) as transaction:
+            Model = pool.get(model)
+            try:
+                return getattr(Model, method)(Model.browse(ids), **kwargs)
+            except backend.DatabaseOperationalError:
+                if count < retry:
+                    transaction.rollback()
+                    count += 1
+                    logger.debug('retry %s of chunk %s-%s of %s.%s',
+                        count, ids[0], ids[-1], model, method)
+                    continue
+                raise
@@ -0,0 +1,236 @@
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+import datetime
+from decimal import Decimal
+
+from sql import Union
+from sql.aggregate import Sum
+
+from trytond.model import Index, ModelSQL, ModelView, Workflow, fields
+from trytond.pool import Pool, PoolMeta
+from trytond.transaction import Transaction
+
+__all__ = ['Period', 'PeriodAnalyticCache']
+
+
+class Period(metaclass=PoolMeta):
+    __name__ = 'stock.period'
+    analytic_caches = fields.One2Many('stock.period.analytic_cache', 'period',
+        'Analytic Caches', readonly=True)
+
+    @classmethod
+    def copy(cls, periods, default=None):
+        if default is None:
+            default = {}
+        else:
+            default = default.copy()
+        default.setdefault('analytic_caches', None)
+        return super(Period, cls).copy(periods, default=default)
+
+    @classmethod
+    @ModelView.button
+    @Workflow.transition('draft')
+    def draft(cls, periods):
+        pool = Pool()
+        AnalyticCache = pool.get('stock.period.analytic_cache')
+        super(Period, cls).draft(periods)
+        AnalyticCache.delete(AnalyticCache.search([
+                    ('period', 'in', [p.id for p in periods]),
+                    ], order=[]))
+
+    @classmethod
+    @ModelView.button
+    @Workflow.transition('closed')
+    def close(cls, periods):
+        pool = Pool()
+        AnalyticCache = pool.get('stock.period.analytic_cache')
+        super(Period, cls).close(periods)
+        cls.post_pending_analytic_lines(periods)
+        AnalyticCache.build(periods)
+
+    @classmethod
+    def rebuild_analytic_caches(cls, company, date=None):
+        '''
+        Rebuild the analytic caches of the closed periods of the company
+        from date (all if None).
+        '''
+        pool = Pool()
+        AnalyticCache = pool.get('stock.period.analytic_cache')
+        domain = [
+            ('company', '=', int(company)),
+            ('state', '=', 'closed'),
+            ]
+        if date:
+            domain.append(('date', '>=', date))
+        periods = cls.search(domain, order=[('date', 'ASC')])
+        AnalyticCache.delete(AnalyticCache.search([
+                    ('period', 'in', [p.id for p in periods]),
+                    ], order=[]))
+        AnalyticCache.build(periods)
+
+    @classmethod
+    def post_pending_analytic_lines(cls, periods):
+        '''
+        Post the analytic lines of the moves of the periods pending of
+        analytic posting so they are included in the analytic caches.
+        '''
+        pool = Pool()
+        Move = pool.get('stock.move')
+        for period in periods:
+            moves = Move.search([
+                    ('company', '=', period.company.id),
+                    ('analytic_pending', '=', True),
+                    ('effective_date', '<=', period.date),
+                    ], order=[('id', 'ASC')])
+            if moves:
+                Move.post_analytic_lines(moves)
+
+
+class PeriodAnalyticCache(ModelSQL):
+    'Stock Period Analytic Cache'
+    __name__ = 'stock.period.analytic_cache'
+    period = fields.Many2One('stock.period', 'Period', required=True,
+        readonly=True, ondelete='CASCADE')
+    account = fields.Many2One('analytic_account.account', 'Analytic Account',
+        required=True, readonly=True, ondelete='CASCADE')
+    location = fields.Many2One('stock.location', 'Location', required=True,
+        readonly=True, ondelete='CASCADE')
+    product = fields.Many2One('product.product', 'Product', required=True,
+        readonly=True, ondelete='CASCADE')
+    debit = fields.Numeric('Debit', required=True, readonly=True)
+    credit = fields.Numeric('Credit', required=True, readonly=True)
+
+    @classmethod
+    def __setup__(cls):
+        super(PeriodAnalyticCache, cls).__setup__()
+        t = cls.__table__()
+        cls._sql_indexes.update({
+                Index(t,
+                    (t.period, Index.Range()),
+                    (t.account, Index.Range()),
+                    (t.location, Index.Range()),
+                    (t.product, Index.Range())),
+                })
+
+    @classmethod
+    def __register__(cls, module_name):
+        pool = Pool()
+        Period = pool.get('stock.period')
+        cursor = Transaction().connection.cursor()
+        table = cls.__table__()
+        super(PeriodAnalyticCache, cls).__register__(module_name)
+        # the periods closed before the cache existed are built on update
+        cursor.execute(*table.select(table.id, limit=1))
+        if not cursor.fetchone():
+            periods = Period.search([
+                    ('state', '=', 'closed'),
+                    ], order=[('date', 'ASC')])
+            if periods:
+                cls.build(periods)
+
+    @classmethod
+    def build(cls, periods):
+        '''
+        Store the analytic totals of the stock moves up to the date of each
+        period by account, location and product.
+        The totals are computed from the cache of the previous closed period
+        having one and the analytic lines after it.
+        '''
+        pool = Pool()
+        Period = pool.get('stock.period')
+        cursor = Transaction().connection.cursor()
+
+        # the periods closed together are not yet closed
+        built = {}
+        for period in sorted(periods, key=lambda p: (p.company.id, p.date)):
+            previous = None
+            previous_periods = Period.search([
+                    ('company', '=', period.company.id),
+                    ('state', '=', 'closed'),
+                    ('date', '<', period.date),
+                    ('id', 'not in', [p.id for p in periods]),
+                    ('analytic_caches', '!=', None),
+                    ], order=[('date', 'DESC')], limit=1)
+            if previous_periods:
+                previous, = previous_periods
+            other = built.get(period.company.id)
+            if other and (not previous or other.date > previous.date):
+                previous = other
+
+            cursor.execute(*cls._balances_query(
+                    period.company, previous, period.date))
+            cls.create([{
+                        'period': period.id,
+                        'account': account,
+                        'location': location,
+                        'product': product,
+                        'debit': Decimal(str(debit)),
+                        'credit': Decimal(str(credit)),
+                        } for account, location, product, debit, credit
+                    in cursor.fetchall()])
+            built[period.company.id] = period
+
+    @classmethod
+    def get_balances(cls, company, date=None):
+        '''
+        Return a dictionary with the debit and credit of the analytic lines
+        of the stock moves of the company up to date (included) by
+        (account id, location id, product id).
+        Only the lines after the latest closed period having a cache are read.
+        '''
+        pool = Pool()
+        Period = pool.get('stock.period')
+        cursor = Transaction().connection.cursor()
+
+        domain = [
+            ('company', '=', company.id),
+            ('state', '=', 'closed'),
+            ('analytic_caches', '!=', None),
+            ]
+        if date:
+            domain.append(('date', '<=', date))
+        periods = Period.search(domain, order=[('date', 'DESC')], limit=1)
+        period = periods[0] if periods else None
+
+        cursor.execute(*cls._balances_query(company, period, date))
+        return {(a, l, p): (Decimal(str(d)), Decimal(str(c)))
+            for a, l, p, d, c in cursor}
+
+    @classmethod
+    def _balances_query(cls, company, period=None, to_date=None):
+        '''
+        Return the query of the debit and credit by account, location and
+        product of the cache of period and of the analytic lines of stock
+        moves after it up to to_date.
+        '''
+        pool = Pool()
+        AnalyticFlow = pool.get('stock.reporting.analytic_flow')
+
+        context = {
+            'company': company.id,
+            'from_date': (period.date + datetime.timedelta(days=1)
+                if period else None),
+            'to_date': to_date,
+            }
+        with Transaction().set_context(context):
+            lines = Union(
+                AnalyticFlow._lines_query(
+                    'income_stock_move', 'from_location'),
+                AnalyticFlow._lines_query(
+                    'expense_stock_move', 'to_location'),
+                AnalyticFlow._consolidated_lines_query(),
+                all_=True)
+        queries = [lines.select(
+                lines.account, lines.location, lines.product,
+                lines.debit, lines.credit)]
+        if period:
+            cache = cls.__table__()
+            queries.append(cache.select(
+                    cache.account, cache.location, cache.product,
+                    cache.debit, cache.credit,
+                    where=cache.period == period.id))
+        union = Union(*queries, all_=True)
+        return union.select(
+            union.account, union.location, union.product,
+            Sum(union.debit), Sum(union.credit),
+            group_by=[union.account, union.location, union.product])
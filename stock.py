@@ -1,11 +1,76 @@
 # The COPYRIGHT file at the top level of this repository contains the full
 # copyright notices and license terms.
+import datetime
+from collections import defaultdict
+from functools import partial
 from decimal import Decimal
-from trytond.model import Workflow, ModelView, fields
+from sql import Literal, Null, Union
+from sql.conditionals import Case, Coalesce
+from trytond.cache import Cache
+from trytond import config
+from trytond.model import Index, ModelSQL, Workflow, ModelView, fields
+from trytond.modules.currency.fields import Monetary
 from trytond.pool import Pool, PoolMeta
-from trytond.transaction import Transaction
+from trytond.tools import grouped_slice
+from trytond.transaction import (
+    Transaction, record_cache_size, without_check_access)
+from trytond.wizard import Wizard, StateView, StateTransition, Button
+from .memo import AnalyticMemo
+from .metrics import measure
+from . import export
+from . import parallel
 
-__all__ = ['AnalyticLine', 'Location', 'Move']
+__all__ = ['AnalyticAccountEntry', 'AnalyticLine', 'AnalyticLineStockMove',
+    'Location', 'LocationAnalyticAccount',
+    'LocationCompany', 'Move', 'RecomputeAnalyticLinesStart',
+    'RecomputeAnalyticLinesResult', 'RecomputeAnalyticLines',
+    'PreviewAnalyticLinesResult', 'PreviewAnalyticLinesTotal',
+    'PreviewAnalyticLines']
+
+
+class AnalyticAccountEntry(metaclass=PoolMeta):
+    __name__ = 'analytic.account.entry'
+
+    @classmethod
+    def _analytic_location_companies(cls, entries):
+        pool = Pool()
+        LocationCompany = pool.get('stock.location.company')
+        return {e.origin.company.id for e in entries
+            if isinstance(e.origin, LocationCompany) and e.origin.company}
+
+    @classmethod
+    def on_write(cls, entries, values):
+        pool = Pool()
+        LocationAnalyticAccount = pool.get('stock.location.analytic_account')
+        callback = super(AnalyticAccountEntry, cls).on_write(entries, values)
+        if 'origin' in values:
+            companies = cls._analytic_location_companies(entries)
+            if companies:
+                callback.append(
+                    lambda: LocationAnalyticAccount.refresh(companies))
+        return callback
+
+    @classmethod
+    def on_delete(cls, entries):
+        pool = Pool()
+        LocationAnalyticAccount = pool.get('stock.location.analytic_account')
+        callback = super(AnalyticAccountEntry, cls).on_delete(entries)
+        companies = cls._analytic_location_companies(entries)
+        if companies:
+            callback.append(
+                lambda: LocationAnalyticAccount.refresh(companies))
+        return callback
+
+    @classmethod
+    def on_modification(cls, mode, entries, field_names=None):
+        pool = Pool()
+        LocationAnalyticAccount = pool.get('stock.location.analytic_account')
+        super(AnalyticAccountEntry, cls).on_modification(mode, entries,
+            field_names=field_names)
+        if mode != 'delete':
+            companies = cls._analytic_location_companies(entries)
+            if companies:
+                LocationAnalyticAccount.refresh(companies)
 
 
 class AnalyticLine(metaclass=PoolMeta):
@@ -14,21 +79,396 @@ class AnalyticLine(metaclass=PoolMeta):
             ondelete='CASCADE', readonly=True)
     expense_stock_move = fields.Many2One('stock.move', 'Expense Stock Move',
             ondelete='CASCADE', readonly=True)
+    stock_moves = fields.One2Many('analytic_account.line.stock_move', 'line',
+        'Stock Moves', readonly=True,
+        help='The stock moves consolidated in this line.')
+
+    @classmethod
+    def __setup__(cls):
+        super(AnalyticLine, cls).__setup__()
+        t = cls.__table__()
+        cls._sql_indexes.update({
+                Index(t, (t.income_stock_move, Index.Range()),
+                    where=t.income_stock_move != Null),
+                Index(t, (t.expense_stock_move, Index.Range()),
+                    where=t.expense_stock_move != Null),
+                Index(t,
+                    (t.account, Index.Range()),
+                    (t.date, Index.Range()),
+                    where=t.income_stock_move != Null),
+                Index(t,
+                    (t.account, Index.Range()),
+                    (t.date, Index.Range()),
+                    where=t.expense_stock_move != Null),
+                })
+
+    @classmethod
+    def _stock_export_columns(cls):
+        return [
+            ('line', 'integer'),
+            ('company', 'integer'),
+            ('date', 'date'),
+            ('account', 'integer'),
+            ('account_code', 'char'),
+            ('type', 'char'),
+            ('debit', 'numeric'),
+            ('credit', 'numeric'),
+            ('move', 'integer'),
+            ('product', 'integer'),
+            ('location', 'integer'),
+            ('from_location', 'integer'),
+            ('to_location', 'integer'),
+            ('shipment', 'char'),
+            ('reference', 'char'),
+            ('timestamp', 'datetime'),
+            ]
+
+    @classmethod
+    def export_stock_lines(cls, file, format='csv', company=None, since=None,
+            chunk_size=None, overlap=None):
+        '''
+        Write to file the analytic lines of stock moves with their move,
+        product, location and shipment columns, one row by move so the
+        consolidated lines are split by their stock moves.
+        The location is the one the analytic account comes from.
+        Only the lines created or modified since the since timestamp minus
+        overlap are exported when it is given. The overlap catches the lines
+        committed after the previous export by longer transactions, so the
+        rows already exported must be de-duplicated by line and move.
+        The lines are read by chunks of chunk_size lines directly from the
+        database so the memory used does not depend on the number of lines.
+        Return the number of rows written and the greatest timestamp to use
+        as since for the next incremental export.
+        '''
+        pool = Pool()
+        LineStockMove = pool.get('analytic_account.line.stock_move')
+        cursor = Transaction().connection.cursor()
+
+        if chunk_size is None:
+            chunk_size = config.getint('analytic_stock', 'export_chunk',
+                default=10000)
+        line = cls.__table__()
+        part = LineStockMove.__table__()
+        where = ((line.income_stock_move != Null)
+            | (line.expense_stock_move != Null)
+            | line.id.in_(part.select(part.line)))
+        if since:
+            if isinstance(since, str):
+                since = datetime.datetime.fromisoformat(since)
+            if overlap is None:
+                overlap = datetime.timedelta(seconds=config.getint(
+                        'analytic_stock', 'export_overlap', default=3600))
+            where &= (Coalesce(line.write_date, line.create_date)
+                >= since - overlap)
+
+        out = export.writer(format, file, cls._stock_export_columns())
+        count = 0
+        watermark = since
+        last_id = 0
+        while True:
+            cursor.execute(*line.select(line.id,
+                    where=where & (line.id > last_id),
+                    order_by=[line.id.asc],
+                    limit=chunk_size))
+            ids = [i for i, in cursor]
+            if not ids:
+                break
+            last_id = ids[-1]
+            cursor.execute(*cls._stock_export_query(ids, company))
+            rows = cursor.fetchall()
+            out.write(rows)
+            count += len(rows)
+            for row in rows:
+                timestamp = row[-1]
+                if isinstance(timestamp, str):
+                    timestamp = datetime.datetime.fromisoformat(timestamp)
+                if timestamp and (not watermark or timestamp > watermark):
+                    watermark = timestamp
+        out.close()
+        return count, watermark
+
+    @classmethod
+    def _stock_export_query(cls, ids, company=None):
+        pool = Pool()
+        AnalyticAccount = pool.get('analytic_account.account')
+        LineStockMove = pool.get('analytic_account.line.stock_move')
+        Move = pool.get('stock.move')
+
+        queries = []
+        for type_, location in [
+                ('income', 'from_location'),
+                ('expense', 'to_location'),
+                None]:
+            line = cls.__table__()
+            move = Move.__table__()
+            account = AnalyticAccount.__table__()
+            if type_ is None:
+                part = LineStockMove.__table__()
+                from_ = part.join(line, condition=part.line == line.id
+                    ).join(move, condition=part.move == move.id)
+                columns = [
+                    part.type, part.debit, part.credit, move.id,
+                    Case((part.type == 'income', move.from_location),
+                        else_=move.to_location)]
+            else:
+                move_field = getattr(line, '%s_stock_move' % type_)
+                from_ = line.join(move, condition=move_field == move.id)
+                columns = [
+                    Literal(type_), line.debit, line.credit, move.id,
+                    getattr(move, location)]
+            from_ = from_.join(account, condition=line.account == account.id)
+            where = line.id.in_(ids)
+            if company:
+                where &= move.company == int(company)
+            type_column, debit, credit, move_id, location_column = columns
+            queries.append(from_.select(
+                    line.id.as_('line'),
+                    move.company.as_('company'),
+                    line.date.as_('date'),
+                    line.account.as_('account'),
+                    account.code.as_('account_code'),
+                    type_column.as_('type'),
+                    debit.as_('debit'),
+                    credit.as_('credit'),
+                    move_id.as_('move'),
+                    move.product.as_('product'),
+                    location_column.as_('location'),
+                    move.from_location.as_('from_location'),
+                    move.to_location.as_('to_location'),
+                    move.shipment.as_('shipment'),
+                    line.reference.as_('reference'),
+                    Coalesce(line.write_date, line.create_date
+                        ).as_('timestamp'),
+                    where=where))
+        union = Union(*queries, all_=True)
+        return union.select(*[getattr(union, n)
+                for n, _ in cls._stock_export_columns()],
+            order_by=[union.line.asc, union.move.asc])
+
+
+class AnalyticLineStockMove(ModelSQL, ModelView):
+    'Analytic Line - Stock Move'
+    __name__ = 'analytic_account.line.stock_move'
+    line = fields.Many2One('analytic_account.line', 'Analytic Line',
+        required=True, ondelete='CASCADE')
+    move = fields.Many2One('stock.move', 'Stock Move', required=True,
+        ondelete='CASCADE')
+    type = fields.Selection([
+            ('income', 'Income'),
+            ('expense', 'Expense'),
+            ], 'Type', required=True)
+    debit = fields.Numeric('Debit', required=True)
+    credit = fields.Numeric('Credit', required=True)
+
+    @classmethod
+    def __setup__(cls):
+        super(AnalyticLineStockMove, cls).__setup__()
+        t = cls.__table__()
+        cls._sql_indexes.update({
+                Index(t, (t.line, Index.Range())),
+                Index(t, (t.move, Index.Range())),
+                })
 
 
 class Location(metaclass=PoolMeta):
     __name__ = 'stock.location'
 
+    @classmethod
+    def __setup__(cls):
+        super(Location, cls).__setup__()
+        cls._enabled_location_types = None
+
+    @classmethod
+    def on_modification(cls, mode, locations, field_names=None):
+        pool = Pool()
+        Move = pool.get('stock.move')
+        super(Location, cls).on_modification(mode, locations,
+            field_names=field_names)
+        # the inherited analytic accounts depend on the tree
+        if mode != 'write' or 'parent' in field_names:
+            Move._analytic_accounts_cache.clear()
+
     @classmethod
     def enabled_location_types(cls):
-        location_types = super(Location, cls).enabled_location_types()
-        if 'storage' not in location_types:
-            location_types.append('storage')
-        return location_types
+        # the types depend only on the installed modules
+        if cls._enabled_location_types is None:
+            location_types = super(Location, cls).enabled_location_types()
+            if 'storage' not in location_types:
+                location_types.append('storage')
+            cls._enabled_location_types = tuple(location_types)
+        return list(cls._enabled_location_types)
+
+
+class LocationAnalyticAccount(ModelSQL):
+    'Location - Analytic Account'
+    __name__ = 'stock.location.analytic_account'
+    company = fields.Many2One('company.company', 'Company', required=True,
+        ondelete='CASCADE')
+    location = fields.Many2One('stock.location', 'Location', required=True,
+        ondelete='CASCADE')
+    account = fields.Many2One('analytic_account.account', 'Account',
+        required=True, ondelete='CASCADE')
+
+    @classmethod
+    def __setup__(cls):
+        super(LocationAnalyticAccount, cls).__setup__()
+        t = cls.__table__()
+        cls._sql_indexes.update({
+                Index(t,
+                    (t.company, Index.Range()),
+                    (t.location, Index.Range()),
+                    (t.account, Index.Range())),
+                })
+
+    @classmethod
+    def __register__(cls, module_name):
+        cursor = Transaction().connection.cursor()
+        table = cls.__table__()
+        super(LocationAnalyticAccount, cls).__register__(module_name)
+        cursor.execute(*table.select(table.id, limit=1))
+        if not cursor.fetchone():
+            cls.refresh()
+
+    @classmethod
+    def refresh(cls, company_ids=None):
+        '''
+        Rebuild from the analytic entries of the location companies the
+        analytic accounts of the locations of the companies (all if None).
+        '''
+        pool = Pool()
+        AnalyticEntry = pool.get('analytic.account.entry')
+        LocationCompany = pool.get('stock.location.company')
+        Move = pool.get('stock.move')
+        cursor = Transaction().connection.cursor()
+        table = cls.__table__()
+        entry = AnalyticEntry.__table__()
+        location_company = LocationCompany.__table__()
+
+        where = entry.account != Null
+        delete_where = Literal(True)
+        if company_ids is not None:
+            company_ids = list(company_ids)
+            where &= location_company.company.in_(company_ids)
+            delete_where = table.company.in_(company_ids)
+        cursor.execute(*table.delete(where=delete_where))
+        query = entry.join(location_company,
+            condition=entry.origin.like(LocationCompany.__name__ + ',%')
+            & (AnalyticEntry.origin.sql_id(entry.origin, LocationCompany)
+                == location_company.id)
+            ).select(
+                location_company.company, location_company.location,
+                entry.account,
+                where=where,
+                group_by=[location_company.company, location_company.location,
+                    entry.account])
+        cursor.execute(*table.insert(
+                [table.company, table.location, table.account], query))
+        Move._analytic_accounts_cache.clear()
+
+    @classmethod
+    def get_accounts(cls, company_ids):
+        '''
+        Return for each company id a dictionary with the sorted tuple of the
+        analytic account ids of each location id.
+        The locations without configuration inherit the accounts of their
+        nearest configured ancestor.
+        '''
+        cursor = Transaction().connection.cursor()
+        table = cls.__table__()
+
+        result = {c: {} for c in company_ids}
+        for sub_ids in grouped_slice(list(company_ids)):
+            cursor.execute(*table.select(
+                    table.company, table.location, table.account,
+                    where=table.company.in_(list(sub_ids)),
+                    order_by=[table.company, table.location, table.account]))
+            for company_id, location_id, account_id in cursor:
+                result[company_id].setdefault(location_id, []).append(
+                    account_id)
+        return {c: cls._inherit_accounts(
+                {l: tuple(a) for l, a in accounts.items()})
+            for c, accounts in result.items()}
+
+    @classmethod
+    def _inherit_accounts(cls, accounts):
+        '''
+        Return the dictionary of the accounts of the configured location ids
+        completed with their descendants using the left and right of the
+        location tree.
+        '''
+        pool = Pool()
+        Location = pool.get('stock.location')
+        cursor = Transaction().connection.cursor()
+        location = Location.__table__()
+        parent = Location.__table__()
+
+        if not accounts:
+            return {}
+        locations = {}
+        for sub_ids in grouped_slice(list(accounts)):
+            cursor.execute(*location.join(parent,
+                    condition=(location.left >= parent.left)
+                    & (location.right <= parent.right)
+                    ).select(location.id, location.left, location.right,
+                    where=parent.id.in_(list(sub_ids))))
+            locations.update((i, (l, r)) for i, l, r in cursor)
+
+        # walk the locations in tree order keeping the stack of the
+        # configured ancestors of the current location
+        result = {}
+        ancestors = []
+        for location_id, (left, right) in sorted(
+                locations.items(), key=lambda l: l[1][0]):
+            while ancestors and ancestors[-1][0] < left:
+                ancestors.pop()
+            if location_id in accounts:
+                ancestors.append((right, accounts[location_id]))
+            if ancestors:
+                result[location_id] = ancestors[-1][1]
+        return result
+
+
+class LocationCompany(metaclass=PoolMeta):
+    __name__ = 'stock.location.company'
+
+    @classmethod
+    def on_write(cls, records, values):
+        pool = Pool()
+        LocationAnalyticAccount = pool.get('stock.location.analytic_account')
+        callback = super(LocationCompany, cls).on_write(records, values)
+        companies = {r.company.id for r in records if r.company}
+        if companies:
+            callback.append(
+                lambda: LocationAnalyticAccount.refresh(companies))
+        return callback
+
+    @classmethod
+    def on_delete(cls, records):
+        pool = Pool()
+        LocationAnalyticAccount = pool.get('stock.location.analytic_account')
+        callback = super(LocationCompany, cls).on_delete(records)
+        companies = {r.company.id for r in records if r.company}
+        if companies:
+            callback.append(
+                lambda: LocationAnalyticAccount.refresh(companies))
+        return callback
+
+    @classmethod
+    def on_modification(cls, mode, records, field_names=None):
+        pool = Pool()
+        LocationAnalyticAccount = pool.get('stock.location.analytic_account')
+        super(LocationCompany, cls).on_modification(mode, records,
+            field_names=field_names)
+        if mode != 'delete':
+            LocationAnalyticAccount.refresh(
+                {r.company.id for r in records if r.company})
 
 
 class Move(metaclass=PoolMeta):
     __name__ = 'stock.move'
+    # analytic account ids of the locations by company
+    _analytic_accounts_cache = Cache('stock.move.analytic_accounts',
+        context=False)
     income_analytic_lines = fields.One2Many('analytic_account.line',
         'income_stock_move', 'Income Analytic Lines', readonly=True,
         help='Analytic lines to manage analytical costs of stock moves when '
@@ -41,6 +481,78 @@ class Move(metaclass=PoolMeta):
         'these aren\'t originated on sales nor purchases.\n'
         'These are the analytic lines that computes the value of this move as '
         'expense for source location.')
+    consolidated_analytic_lines = fields.One2Many(
+        'analytic_account.line.stock_move', 'move',
+        'Consolidated Analytic Lines', readonly=True,
+        help='The part of this move in the analytic lines consolidated by '
+        'shipment.')
+    analytic_pending = fields.Boolean('Analytic Pending', readonly=True,
+        help='The move is done but its analytic lines are not created yet '
+        'because the analytic posting of the company is deferred.')
+
+    @classmethod
+    def __setup__(cls):
+        super(Move, cls).__setup__()
+        t = cls.__table__()
+        cls._sql_indexes.add(
+            Index(t, (t.id, Index.Range()),
+                where=t.analytic_pending == Literal(True)))
+
+    @staticmethod
+    def default_analytic_pending():
+        return False
+
+    @classmethod
+    def _analytic_amount_fields(cls):
+        '''
+        Return the fields of done moves that change their analytic amount.
+        '''
+        return {'cost_price', 'unit_price', 'currency'}
+
+    @classmethod
+    def on_modification(cls, mode, moves, field_names=None):
+        super(Move, cls).on_modification(mode, moves, field_names=field_names)
+        # state changes are managed by do and cancel transitions
+        if (mode == 'write' and 'state' not in field_names
+                and set(field_names) & cls._analytic_amount_fields()):
+            cls.create_analytic_delta_lines(
+                [m for m in moves if m.state == 'done'])
+
+    @classmethod
+    def on_delete(cls, moves):
+        pool = Pool()
+        AnalyticLine = pool.get('analytic_account.line')
+        LineStockMove = pool.get('analytic_account.line.stock_move')
+        callback = super(Move, cls).on_delete(moves)
+        # the parts and the lines of the moves are deleted in cascade but the
+        # consolidated lines are shared with the other moves of the shipment
+        move_ids = [m.id for m in moves]
+        parts = LineStockMove.search([
+                ('move', 'in', move_ids),
+                ], order=[])
+        if not parts:
+            return callback
+        amounts = defaultdict(lambda: [Decimal(0), Decimal(0)])
+        for part in parts:
+            amounts[part.line][0] += part.debit
+            amounts[part.line][1] += part.credit
+        shared = {p.line for p in LineStockMove.search([
+                    ('line', 'in', [l.id for l in amounts]),
+                    ('move', 'not in', move_ids),
+                    ], order=[])}
+        to_write = []
+        for line, (debit, credit) in amounts.items():
+            if line in shared:
+                to_write.extend(([line], {
+                            'debit': line.debit - debit,
+                            'credit': line.credit - credit,
+                            }))
+        if to_write:
+            AnalyticLine.write(*to_write)
+        to_delete = [l for l in amounts if l not in shared]
+        if to_delete:
+            AnalyticLine.delete(to_delete)
+        return callback
 
     @classmethod
     def copy(cls, moves, default=None):
@@ -49,6 +561,8 @@ class Move(metaclass=PoolMeta):
         default = default.copy()
         default.setdefault('income_analytic_lines', None)
         default.setdefault('expense_analytic_lines', None)
+        default.setdefault('consolidated_analytic_lines', None)
+        default.setdefault('analytic_pending', False)
         return super(Move, cls).copy(moves, default=default)
 
     @classmethod
@@ -56,18 +570,461 @@ class Move(metaclass=PoolMeta):
     @Workflow.transition('done')
     def do(cls, moves):
         super(Move, cls).do(moves)
+        to_post, to_defer = [], []
+        for move in moves:
+            if move.company.analytic_stock_posting == 'deferred':
+                to_defer.append(move)
+            else:
+                to_post.append(move)
+        cls.create_analytic_lines(to_post)
+        if to_defer:
+            cls.write(to_defer, {'analytic_pending': True})
+            with Transaction().set_context(queue_batch=True):
+                cls.__queue__.post_analytic_lines(to_defer)
+
+    @classmethod
+    @ModelView.button
+    @Workflow.transition('cancelled')
+    def cancel(cls, moves):
+        done = [m for m in moves if m.state == 'done']
+        super(Move, cls).cancel(moves)
+        cls.create_analytic_delta_lines(done)
+
+    @classmethod
+    def post_analytic_lines(cls, moves):
+        '''
+        Create the analytic lines of the moves pending of analytic posting.
+        Moves already posted are skipped so the task can be safely retried.
+        '''
+        cls.lock(moves)
+        moves = cls.browse([m.id for m in moves])
+        moves = [m for m in moves if m.analytic_pending]
+        if not moves:
+            return
+        cls.create_analytic_lines([m for m in moves if m.state == 'done'])
+        cls.write(moves, {'analytic_pending': False})
+
+    @classmethod
+    def post_pending_analytic_lines(cls, company=None, processes=None,
+            chunk_size=None):
+        '''
+        Post the analytic lines of the moves pending of analytic posting.
+        If processes is greater than 1, the moves are posted by chunks in a
+        pool of processes, each with its own transaction.
+        Return the list of (move ids, error) of the chunks that failed.
+        '''
+        domain = [('analytic_pending', '=', True)]
+        if company:
+            domain.append(('company', '=', int(company)))
+        moves = cls.search(domain, order=[('id', 'ASC')])
+        if processes and processes > 1:
+            _, failures = parallel.run(cls.__name__, 'post_analytic_lines',
+                [m.id for m in moves], processes=processes,
+                chunk_size=chunk_size)
+            return failures
+        for sub_moves in grouped_slice(moves, chunk_size):
+            cls.post_analytic_lines(cls.browse(sub_moves))
+        return []
+
+    @classmethod
+    def create_analytic_lines(cls, moves):
+        '''
+        Create the income and expense analytic lines of all moves with a
+        single create call.
+        '''
+        pool = Pool()
+        AnalyticLine = pool.get('analytic_account.line')
+
+        to_create = cls._consolidate_analytic_lines(moves,
+            cls._get_analytic_lines_to_create(moves))
+        if to_create:
+            # the consolidated parts are only created by the code
+            with measure('write', moves=len(moves)) as m, \
+                    without_check_access():
+                AnalyticLine.create(to_create)
+                m.lines = len(to_create)
+
+    @classmethod
+    def _consolidate_analytic_lines(cls, moves, lines_vals):
+        '''
+        Merge the analytic lines values of the moves of the same shipment
+        whose company consolidates analytic lines into one line by type,
+        date and account.
+        The part of each move is kept in 'stock_moves'.
+        '''
+        shipments = {m.id: str(m.shipment) for m in moves
+            if m.shipment and m.company.analytic_stock_consolidate}
+        if not shipments:
+            return lines_vals
+
+        result = []
+        groups = {}
+        for vals in lines_vals:
+            type_ = 'income' if vals.get('income_stock_move') else 'expense'
+            link = '%s_stock_move' % type_
+            move_id = vals[link]
+            if move_id not in shipments:
+                result.append(vals)
+                continue
+            key = (type_, shipments[move_id]) + tuple(sorted(
+                    (k, v) for k, v in vals.items()
+                    if k not in {link, 'debit', 'credit'}))
+            group = groups.get(key)
+            if group is None:
+                group = groups[key] = vals.copy()
+                del group[link]
+                group['debit'] = group['credit'] = Decimal(0)
+                group['stock_moves'] = [('create', [])]
+                result.append(group)
+            group['debit'] += vals['debit']
+            group['credit'] += vals['credit']
+            group['stock_moves'][0][1].append({
+                    'move': move_id,
+                    'type': type_,
+                    'debit': vals['debit'],
+                    'credit': vals['credit'],
+                    })
+        return result
+
+    @classmethod
+    def _get_analytic_lines_to_create(cls, moves):
+        '''
+        Return the values of the analytic lines of all moves, linked to their
+        move by 'income_stock_move' or 'expense_stock_move'.
+        '''
+        with measure('prefetch', moves=len(moves)):
+            moves = cls._analytic_browse(moves)
+        # resolve the analytic accounts of all locations with one query and
+        # drop the moves that do not cross an analytic boundary
+        with measure('accounts', moves=len(moves)):
+            moves = cls._filter_analytic_boundary(moves)
+        with measure('amounts', moves=len(moves)) as m:
+            memo = AnalyticMemo.get()
+            hits, misses = memo.hits, memo.misses
+            amounts = cls._get_analytic_amounts(moves)
+            m.hits = memo.hits - hits
+            m.misses = memo.misses - misses
+
+        to_create = []
+        with measure('lines', moves=len(moves)) as m:
+            for move in moves:
+                vals = move._analytic_vals(amount=amounts.get(move.id))
+                if not vals:
+                    continue
+                for field, link in (
+                        ('income_analytic_lines', 'income_stock_move'),
+                        ('expense_analytic_lines', 'expense_stock_move'),
+                        ):
+                    for action, lines_vals in vals.get(field, []):
+                        assert action == 'create'
+                        for line_vals in lines_vals:
+                            line_vals = line_vals.copy()
+                            line_vals[link] = move.id
+                            to_create.append(line_vals)
+            m.lines = len(to_create)
+        return to_create
+
+    @classmethod
+    def preview_analytic_lines(cls, moves, chunk_size=None):
+        '''
+        Yield the values of the analytic lines that the moves would create
+        once done, computed and consolidated like create_analytic_lines by
+        chunks of about chunk_size moves so the memory used does not depend on
+        the number of moves. The moves of a shipment are in the same chunk.
+        The lines of the moves without effective date are dated today.
+        Nothing is written.
+        '''
+        pool = Pool()
+        Date = pool.get('ir.date')
+
+        if chunk_size is None:
+            chunk_size = record_cache_size(Transaction())
+        today = Date.today()
+        for sub_moves in cls._analytic_preview_chunks(moves, chunk_size):
+            for vals in cls._consolidate_analytic_lines(sub_moves,
+                    cls._get_analytic_lines_to_create(sub_moves)):
+                if vals.get('date') is None:
+                    vals['date'] = today
+                yield vals
+
+    @classmethod
+    def _analytic_preview_chunks(cls, moves, chunk_size):
+        '''
+        Yield the moves by chunks of at least chunk_size moves without
+        splitting the moves of a shipment.
+        '''
+        moves = sorted(cls.browse([int(m) for m in moves]),
+            key=lambda m: (str(m.shipment) if m.shipment else '', m.id))
+        chunk = []
         for move in moves:
-            vals = move._analytic_vals()
-            if vals:
-                cls.write([move], vals)
+            if (len(chunk) >= chunk_size
+                    and (not move.shipment
+                        or move.shipment != chunk[-1].shipment)):
+                yield chunk
+                chunk = []
+            chunk.append(move)
+        if chunk:
+            yield chunk
 
-    def _analytic_vals(self):
+    @classmethod
+    def preview_analytic_totals(cls, moves, chunk_size=None):
+        '''
+        Return a dictionary with the debit and credit that the moves would
+        post to each analytic account id and the number of lines.
+        '''
+        totals = defaultdict(lambda: [Decimal(0), Decimal(0)])
+        count = 0
+        for vals in cls.preview_analytic_lines(moves, chunk_size=chunk_size):
+            total = totals[vals['account']]
+            total[0] += vals['debit']
+            total[1] += vals['credit']
+            count += 1
+        return {a: tuple(t) for a, t in totals.items()}, count
+
+    @classmethod
+    def create_analytic_delta_lines(cls, moves):
+        '''
+        Create the analytic lines that compensate the difference between the
+        analytic lines of the moves and the expected ones, by move and
+        account. The existing lines are kept.
+        Cancelled moves expect no line so all their lines are reversed.
+        Return the number of lines created.
+        '''
+        pool = Pool()
+        AnalyticLine = pool.get('analytic_account.line')
+        LineStockMove = pool.get('analytic_account.line.stock_move')
+        Date = pool.get('ir.date')
+
+        # the lines of pending moves are not created yet
+        moves = [m for m in moves if not m.analytic_pending]
+        if not moves:
+            return 0
+
+        balances = defaultdict(Decimal)
+        values = {}
+        for vals in cls._get_analytic_lines_to_create(
+                [m for m in moves if m.state == 'done']):
+            key = (vals.get('income_stock_move'),
+                vals.get('expense_stock_move'), vals['account'])
+            balances[key] += vals['debit'] - vals['credit']
+            values.setdefault(key, vals)
+
+        move_ids = [m.id for m in moves]
+        for line in AnalyticLine.search(['OR',
+                    ('income_stock_move', 'in', move_ids),
+                    ('expense_stock_move', 'in', move_ids),
+                    ]):
+            key = (
+                line.income_stock_move.id if line.income_stock_move
+                else None,
+                line.expense_stock_move.id if line.expense_stock_move
+                else None,
+                line.account.id)
+            balances[key] -= line.debit - line.credit
+            values.setdefault(key, cls._analytic_delta_vals(key, line))
+        for part in LineStockMove.search([
+                    ('move', 'in', move_ids),
+                    ]):
+            if part.type == 'income':
+                key = (part.move.id, None, part.line.account.id)
+            else:
+                key = (None, part.move.id, part.line.account.id)
+            balances[key] -= part.debit - part.credit
+            values.setdefault(key, cls._analytic_delta_vals(key, part.line))
+
+        today = Date.today()
+        to_create = []
+        for key, balance in balances.items():
+            if not balance:
+                continue
+            vals = values[key].copy()
+            vals['date'] = today
+            vals['debit'] = balance if balance > 0 else Decimal(0)
+            vals['credit'] = -balance if balance < 0 else Decimal(0)
+            to_create.append(vals)
+        if to_create:
+            with measure('delta', moves=len(moves)) as m:
+                AnalyticLine.create(to_create)
+                m.lines = len(to_create)
+        return len(to_create)
+
+    @staticmethod
+    def _analytic_delta_vals(key, line):
+        return {
+            'income_stock_move': key[0],
+            'expense_stock_move': key[1],
+            'account': key[2],
+            'internal_company': line.internal_company.id,
+            'reference': line.reference,
+            'party': line.party.id if line.party else None,
+            }
+
+    @classmethod
+    def recompute_analytic_lines(cls, company, start_date=None,
+            end_date=None, locations=None, chunk_size=None, commit=False,
+            processes=None, closed_periods=False):
+        '''
+        Recompute the analytic lines of the done moves of the company,
+        optionally filtered by effective date and locations (including their
+        children).
+        The moves are processed in chunks of chunk_size ordered by id. Only the
+        lines that differ from the expected ones are deleted or created.
+        Consolidated lines are shared with other moves so they are
+        compensated with delta lines instead.
+        The moves up to the date of the last closed stock period having an
+        analytic cache are not recomputed as they are included in it, unless
+        closed_periods is True to backfill them, in which case the analytic
+        caches of the closed periods from start_date are rebuilt afterwards.
+        If commit is True, the transaction is committed after each chunk.
+        If processes is greater than 1, the chunks are processed in parallel
+        by a pool of processes, each committing its chunks in its own
+        transaction, so it requires commit.
+        Return the number of lines deleted and created and the list of
+        (move ids, error) of the chunks that failed in parallel.
+        '''
+        pool = Pool()
+        Location = pool.get('stock.location')
+        Period = pool.get('stock.period')
+        transaction = Transaction()
+        cursor = transaction.connection.cursor()
+        move = cls.__table__()
+
+        periods = Period.search([
+                ('company', '=', int(company)),
+                ('state', '=', 'closed'),
+                ('analytic_caches', '!=', None),
+                ], order=[('date', 'DESC')], limit=1)
+        if periods and not closed_periods:
+            period, = periods
+            if not start_date or start_date <= period.date:
+                start_date = period.date + datetime.timedelta(days=1)
+
+        parallel_ = processes and processes > 1
+        if parallel_ and not commit:
+            raise ValueError('Recomputing in parallel requires commit')
+        if chunk_size is None:
+            chunk_size = config.getint('analytic_stock', 'recompute_chunk',
+                default=1000)
+        where = ((move.company == int(company))
+            & (move.state == 'done'))
+        if start_date:
+            where &= move.effective_date >= start_date
+        if end_date:
+            where &= move.effective_date <= end_date
+        if locations:
+            location_ids = [l.id for l in Location.search([
+                        ('parent', 'child_of', [int(l) for l in locations]),
+                        ])]
+            where &= (move.from_location.in_(location_ids)
+                | move.to_location.in_(location_ids))
+
+        def chunks():
+            # keyset pagination keeps memory bounded and, unlike a
+            # server-side cursor, survives the commits between chunks
+            last_id = 0
+            while True:
+                cursor.execute(*move.select(move.id,
+                        where=where & (move.id > last_id),
+                        order_by=[move.id.asc],
+                        limit=chunk_size))
+                ids = [i for i, in cursor]
+                if not ids:
+                    return
+                last_id = ids[-1]
+                yield ids
+
+        deleted = created = 0
+        failures = []
+        if parallel_:
+            # the processes must see the changes of the transaction
+            transaction.commit()
+            results, failures = parallel.run_chunks(cls.__name__,
+                '_recompute_analytic_lines', chunks(), processes=processes)
+        else:
+            results = []
+            for ids in chunks():
+                results.append(cls._recompute_analytic_lines(cls.browse(ids)))
+                if commit:
+                    transaction.commit()
+        for chunk_deleted, chunk_created in results:
+            deleted += chunk_deleted
+            created += chunk_created
+        if closed_periods:
+            Period.rebuild_analytic_caches(company, date=start_date)
+            if commit:
+                transaction.commit()
+        return deleted, created, failures
+
+    @classmethod
+    def _recompute_analytic_lines(cls, moves):
+        pool = Pool()
+        AnalyticLine = pool.get('analytic_account.line')
+        LineStockMove = pool.get('analytic_account.line.stock_move')
+
+        cls.lock(moves)
+        created = 0
+        consolidated = set(p.move for p in LineStockMove.search([
+                    ('move', 'in', [m.id for m in moves]),
+                    ]))
+        if consolidated:
+            created += cls.create_analytic_delta_lines(list(consolidated))
+            moves = [m for m in moves if m not in consolidated]
+
+        expected = {}
+        for vals in cls._get_analytic_lines_to_create(moves):
+            expected.setdefault(cls._analytic_line_key(vals), []).append(vals)
+
+        move_ids = [m.id for m in moves]
+        to_delete = []
+        for line in AnalyticLine.search(['OR',
+                    ('income_stock_move', 'in', move_ids),
+                    ('expense_stock_move', 'in', move_ids),
+                    ], order=[('id', 'ASC')]):
+            key = cls._analytic_line_key(line)
+            if expected.get(key):
+                expected[key].pop()
+            else:
+                to_delete.append(line)
+        to_create = cls._consolidate_analytic_lines(moves,
+            [v for l in expected.values() for v in l])
+
+        if to_delete:
+            AnalyticLine.delete(to_delete)
+        if to_create:
+            with without_check_access():
+                AnalyticLine.create(to_create)
+        pending = [m for m in moves if m.analytic_pending]
+        if pending:
+            cls.write(pending, {'analytic_pending': False})
+        return len(to_delete), created + len(to_create)
+
+    @staticmethod
+    def _analytic_line_key(line):
+        '''
+        Return the key to compare an analytic line with the values of an
+        expected line.
+        '''
+        key = []
+        for name in ['income_stock_move', 'expense_stock_move', 'account',
+                'internal_company', 'date', 'debit', 'credit', 'reference',
+                'party']:
+            if isinstance(line, dict):
+                value = line.get(name)
+            else:
+                value = getattr(line, name, None)
+            if hasattr(value, 'id'):
+                value = value.id
+            key.append(value)
+        return tuple(key)
+
+    def _analytic_vals(self, amount=None):
         '''
         If analytic accounts defined in from_location and to_location are
         diferent, it prepares the values of analytic lines for
         'income_analytic_lines' and 'expense_analytic_lines' fields.
         It uses the 'unit_price' and 'quantity' to compute the amount.
         If 'unit_price' is empty it uses the cost_price.
+        The amount may be given when it is already computed for a batch.
         '''
         pool = Pool()
         PurchaseLine = pool.get('purchase.line')
@@ -84,7 +1041,8 @@ class Move(metaclass=PoolMeta):
             # same analytic accounts => no analytic cost/moves
             return
 
-        amount = self._get_analytic_amount()
+        if amount is None:
+            amount = self._get_analytic_amount()
 
         vals = {}
         if income_analytic_accs and not isinstance(self.origin, SaleLine):
@@ -103,41 +1061,184 @@ class Move(metaclass=PoolMeta):
 
         return vals
 
+    def _analytic_accounts_key(self, type_):
+        location = (self.from_location if type_ == 'income'
+            else self.to_location)
+        return (self.company.id, location.id)
+
     def _get_analytic_accounts(self, type_):
         pool = Pool()
-        AnalyticEntry = pool.get('analytic.account.entry')
+        AnalyticAccount = pool.get('analytic_account.account')
 
-        entries = AnalyticEntry.search([
-                ('origin.company', '=', self.company,
-                    'stock.location.company'),
-                ('origin.location', '=',
-                    self.from_location if type_ == 'income'
-                    else self.to_location,
-                    'stock.location.company'),
-                ('account', '!=', None),
-                ])
-        return [e.account for e in entries]
+        key = self._analytic_accounts_key(type_)
+        account_ids = self._get_location_analytic_accounts([key])[key]
+        return AnalyticAccount.browse(account_ids)
+
+    @classmethod
+    def _get_location_analytic_accounts(cls, keys):
+        '''
+        Return a dictionary with the analytic account ids of each
+        (company id, location id) key.
+        '''
+        accounts = cls._get_company_analytic_accounts(set(k[0] for k in keys))
+        return {k: accounts[k[0]].get(k[1], ()) for k in keys}
+
+    @classmethod
+    def _get_company_analytic_accounts(cls, company_ids):
+        '''
+        Return for each company id a dictionary with the analytic account ids
+        of each configured location id.
+        The companies not found in the cache are read from the location
+        analytic accounts with a single query.
+        '''
+        pool = Pool()
+        LocationAnalyticAccount = pool.get('stock.location.analytic_account')
+
+        result = {}
+        missing = []
+        for company_id in company_ids:
+            accounts = cls._analytic_accounts_cache.get(company_id)
+            if accounts is None:
+                missing.append(company_id)
+            else:
+                result[company_id] = accounts
+        if not missing:
+            return result
+
+        fetched = LocationAnalyticAccount.get_accounts(missing)
+        for company_id, accounts in fetched.items():
+            result[company_id] = cls._analytic_accounts_cache.set(
+                company_id, accounts)
+        return result
+
+    @classmethod
+    def _analytic_browse(cls, moves):
+        '''
+        Return the moves browsed by chunks of the record cache size with the
+        fields used to compute their analytic lines already read, so the
+        number of queries does not depend on the number of moves.
+        '''
+        result = []
+        for sub_moves in grouped_slice(moves,
+                record_cache_size(Transaction())):
+            sub_moves = cls.browse(sub_moves)
+            cls._analytic_prefetch(sub_moves)
+            result.extend(sub_moves)
+        return result
+
+    @classmethod
+    def _analytic_prefetch(cls, moves):
+        '''
+        Read the fields of the moves and of their related records used to
+        compute analytic lines.
+        Reading a field of one record reads it for all the records of the
+        same model instantiated together, so it is enough to touch the first
+        record of each model.
+        '''
+        related = {}
+        for move in moves:
+            for record, names in cls._analytic_prefetch_fields(move):
+                if record is not None and not isinstance(record, str):
+                    related.setdefault((record.__name__, names), record)
+        for (_, names), record in related.items():
+            for name in names:
+                if name in record._fields:
+                    getattr(record, name)
+
+    def _analytic_prefetch_fields(self):
+        '''
+        Yield the related records of the move and the names of their fields
+        used to compute analytic lines.
+        '''
+        yield self.company, ('currency',)
+        yield self.company.currency, ('digits', 'rounding')
+        yield self.product, ('default_uom',)
+        yield self.unit, ('category', 'factor', 'rate', 'rounding')
+        yield self.from_location, ('type',)
+        yield self.to_location, ('type',)
+        yield self.shipment, ('reference', 'customer', 'supplier')
+
+    @classmethod
+    def _filter_analytic_boundary(cls, moves):
+        '''
+        Return the moves whose from and to locations have different analytic
+        accounts and require unit price, the only ones that may have
+        analytic lines.
+        It does not execute any query once the accounts are cached.
+        '''
+        accounts = cls._get_company_analytic_accounts(
+            set(m.company.id for m in moves))
+        boundaries = {}
+        result = []
+        for move in moves:
+            if not move.unit_price_required:
+                continue
+            key = (move.company.id, move.from_location.id,
+                move.to_location.id)
+            if key not in boundaries:
+                company_accounts = accounts[key[0]]
+                boundaries[key] = (
+                    set(company_accounts.get(key[1], ()))
+                    != set(company_accounts.get(key[2], ())))
+            if boundaries[key]:
+                result.append(move)
+        return result
 
     def _get_analytic_amount(self):
+        return self._get_analytic_amounts([self])[self.id]
+
+    @classmethod
+    def _get_analytic_amounts(cls, moves):
+        '''
+        Return a dictionary with the analytic amount of each move id.
+        Currency rates and UoM conversions are memoized for the transaction
+        so they are read once per currencies and date and computed once per
+        UoMs and quantity.
+        '''
         pool = Pool()
         Currency = pool.get('currency.currency')
         Uom = pool.get('product.uom')
 
-        # unit_price is in move's UoM and currency. cost_price is in product's
-        # default_uom and company's currency
-        if self.unit_price:
-            amount = self.unit_price * Decimal(str(self.quantity))
-            if self.currency != self.company.currency:
-                with Transaction().set_context(date=self.effective_date):
-                    amount = Currency.compute(self.currency, amount,
-                        self.company.currency)
-        else:
-            qty = Uom.compute_qty(self.unit, self.quantity,
-                self.product.default_uom)
-            amount = (self.cost_price or Decimal(0)) * Decimal(str(qty))
+        def get_rates(from_currency, to_currency, date, amount):
+            with Transaction().set_context(date=date):
+                from_currency, to_currency = Currency.browse(
+                    [from_currency, to_currency])
+                if not from_currency.rate or not to_currency.rate:
+                    # raise the missing rate error
+                    Currency.compute(from_currency, amount, to_currency)
+                return from_currency.rate, to_currency.rate
+
+        def get_quantity(from_uom, quantity, to_uom):
+            return Decimal(str(Uom.compute_qty(from_uom, quantity, to_uom)))
+
+        memo = AnalyticMemo.get()
+        exponents = {}
+        amounts = {}
+        for move in moves:
+            company_currency = move.company.currency
+            # unit_price is in move's UoM and currency. cost_price is in
+            # product's default_uom and company's currency
+            if move.unit_price:
+                amount = move.unit_price * Decimal(str(move.quantity))
+                if move.currency != company_currency:
+                    from_rate, to_rate = memo.rate(move.currency,
+                        company_currency, move.effective_date,
+                        partial(get_rates, move.currency.id,
+                            company_currency.id, move.effective_date, amount))
+                    amount = company_currency.round(
+                        amount * to_rate / from_rate)
+            else:
+                quantity = memo.quantity(move.unit, move.product.default_uom,
+                    move.quantity,
+                    partial(get_quantity, move.unit, move.quantity,
+                        move.product.default_uom))
+                amount = (move.cost_price or Decimal(0)) * quantity
 
-        digits = self.company.currency.digits
-        return amount.quantize(Decimal(str(10.0 ** -digits)))
+            digits = company_currency.digits
+            if digits not in exponents:
+                exponents[digits] = Decimal(str(10.0 ** -digits))
+            amounts[move.id] = amount.quantize(exponents[digits])
+        return amounts
 
     def _get_analytic_lines_vals(self, type_, analytic_accounts, amount):
         base_vals = {
@@ -164,3 +1265,117 @@ class Move(metaclass=PoolMeta):
             vals['account'] = account.id
             lines_vals.append(vals)
         return lines_vals
+
+
+class RecomputeAnalyticLinesStart(ModelView):
+    'Recompute Analytic Lines Start'
+    __name__ = 'stock.move.recompute_analytic_lines.start'
+    company = fields.Many2One('company.company', 'Company', required=True)
+    start_date = fields.Date('Start Date')
+    end_date = fields.Date('End Date')
+    locations = fields.Many2Many('stock.location', None, None, 'Locations',
+        help='Leave empty to recompute the moves of all locations.')
+    closed_periods = fields.Boolean('Closed Periods',
+        help='Recompute also the moves of the closed stock periods and '
+        'rebuild their analytic caches.')
+
+    @staticmethod
+    def default_company():
+        return Transaction().context.get('company')
+
+
+class RecomputeAnalyticLinesResult(ModelView):
+    'Recompute Analytic Lines Result'
+    __name__ = 'stock.move.recompute_analytic_lines.result'
+    deleted = fields.Integer('Deleted Lines', readonly=True)
+    created = fields.Integer('Created Lines', readonly=True)
+    failed = fields.Integer('Failed Moves', readonly=True)
+
+
+class RecomputeAnalyticLines(Wizard):
+    'Recompute Analytic Lines'
+    __name__ = 'stock.move.recompute_analytic_lines'
+    start = StateView('stock.move.recompute_analytic_lines.start',
+        'analytic_stock.recompute_analytic_lines_start_view_form', [
+            Button('Cancel', 'end', 'tryton-cancel'),
+            Button('Recompute', 'recompute', 'tryton-ok', default=True),
+            ])
+    recompute = StateTransition()
+    result = StateView('stock.move.recompute_analytic_lines.result',
+        'analytic_stock.recompute_analytic_lines_result_view_form', [
+            Button('Close', 'end', 'tryton-close', default=True),
+            ])
+
+    def transition_recompute(self):
+        pool = Pool()
+        Move = pool.get('stock.move')
+        # the chunks are committed in a dedicated transaction so the locks
+        # are released along the way
+        with Transaction().new_transaction():
+            deleted, created, failures = Move.recompute_analytic_lines(
+                self.start.company.id,
+                start_date=self.start.start_date,
+                end_date=self.start.end_date,
+                locations=[l.id for l in self.start.locations],
+                commit=True,
+                closed_periods=self.start.closed_periods)
+        self.result.deleted = deleted
+        self.result.created = created
+        self.result.failed = sum(len(ids) for ids, _ in failures)
+        return 'result'
+
+    def default_result(self, fields):
+        return {
+            'deleted': self.result.deleted,
+            'created': self.result.created,
+            'failed': self.result.failed,
+            }
+
+
+class PreviewAnalyticLinesResult(ModelView):
+    'Preview Analytic Lines Result'
+    __name__ = 'stock.move.preview_analytic_lines.result'
+    lines = fields.Integer('Lines', readonly=True)
+    totals = fields.One2Many('stock.move.preview_analytic_lines.total', None,
+        'Totals', readonly=True)
+
+
+class PreviewAnalyticLinesTotal(ModelView):
+    'Preview Analytic Lines Total'
+    __name__ = 'stock.move.preview_analytic_lines.total'
+    account = fields.Many2One('analytic_account.account', 'Account',
+        readonly=True)
+    debit = Monetary('Debit', currency='currency', digits='currency',
+        readonly=True)
+    credit = Monetary('Credit', currency='currency', digits='currency',
+        readonly=True)
+    balance = Monetary('Balance', currency='currency', digits='currency',
+        readonly=True)
+    currency = fields.Many2One('currency.currency', 'Currency',
+        readonly=True)
+
+
+class PreviewAnalyticLines(Wizard):
+    'Preview Analytic Lines'
+    __name__ = 'stock.move.preview_analytic_lines'
+    start = StateView('stock.move.preview_analytic_lines.result',
+        'analytic_stock.preview_analytic_lines_result_view_form', [
+            Button('Close', 'end', 'tryton-close', default=True),
+            ])
+
+    def default_start(self, fields):
+        pool = Pool()
+        AnalyticAccount = pool.get('analytic_account.account')
+        Move = pool.get('stock.move')
+        totals, count = Move.preview_analytic_totals(self.records)
+        accounts = AnalyticAccount.browse(sorted(totals))
+        return {
+            'lines': count,
+            'totals': [{
+                    'account': account.id,
+                    'debit': totals[account.id][0],
+                    'credit': totals[account.id][1],
+                    'balance': totals[account.id][0] - totals[account.id][1],
+                    'currency': account.company.currency.id,
+                    } for account in accounts],
+            }
@@ -0,0 +1,172 @@
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+from sql import Union
+from sql.aggregate import Min, Sum
+from sql.conditionals import Case
+from sql.functions import DateTrunc
+
+from trytond.model import ModelSQL, ModelView, fields
+from trytond.modules.currency.fields import Monetary
+from trytond.pool import Pool
+from trytond.pyson import Eval, If
+from trytond.transaction import Transaction
+
+__all__ = ['AnalyticFlow', 'AnalyticFlowContext']
+
+
+class AnalyticFlow(ModelSQL, ModelView):
+    'Stock Analytic Flow'
+    __name__ = 'stock.reporting.analytic_flow'
+    company = fields.Many2One('company.company', 'Company', readonly=True)
+    account = fields.Many2One('analytic_account.account', 'Analytic Account',
+        readonly=True)
+    location = fields.Many2One('stock.location', 'Location', readonly=True)
+    product = fields.Many2One('product.product', 'Product', readonly=True)
+    date = fields.Date('Date', readonly=True)
+    debit = Monetary('Debit', currency='currency', digits='currency',
+        readonly=True)
+    credit = Monetary('Credit', currency='currency', digits='currency',
+        readonly=True)
+    balance = Monetary('Balance', currency='currency', digits='currency',
+        readonly=True)
+    currency = fields.Many2One('currency.currency', 'Currency',
+        readonly=True)
+
+    @classmethod
+    def __setup__(cls):
+        super(AnalyticFlow, cls).__setup__()
+        cls._order.insert(0, ('date', 'DESC'))
+
+    @classmethod
+    def table_query(cls):
+        '''
+        Aggregate the debit and credit of the analytic lines of stock moves
+        by company, account, location, product and period.
+        The location is the one the analytic account comes from: the source
+        location for income lines and the destination location for expense
+        lines. Consolidated lines are split by their stock moves.
+        '''
+        pool = Pool()
+        Company = pool.get('company.company')
+        context = Transaction().context
+
+        lines = Union(
+            cls._lines_query('income_stock_move', 'from_location'),
+            cls._lines_query('expense_stock_move', 'to_location'),
+            cls._consolidated_lines_query(),
+            all_=True)
+        company = Company.__table__()
+        date = cls.date.sql_cast(
+            DateTrunc(context.get('period', 'month'), lines.date))
+        debit, credit = Sum(lines.debit), Sum(lines.credit)
+        return lines.join(company, condition=lines.company == company.id
+            ).select(
+                Min(lines.id).as_('id'),
+                lines.company.as_('company'),
+                lines.account.as_('account'),
+                lines.location.as_('location'),
+                lines.product.as_('product'),
+                date.as_('date'),
+                cls.debit.sql_cast(debit).as_('debit'),
+                cls.credit.sql_cast(credit).as_('credit'),
+                cls.balance.sql_cast(debit - credit).as_('balance'),
+                company.currency.as_('currency'),
+                group_by=[lines.company, lines.account, lines.location,
+                    lines.product, date, company.currency])
+
+    @classmethod
+    def _lines_query(cls, move_field, location_field):
+        pool = Pool()
+        AnalyticLine = pool.get('analytic_account.line')
+        Move = pool.get('stock.move')
+        context = Transaction().context
+
+        line = AnalyticLine.__table__()
+        move = Move.__table__()
+        where = move.company == context.get('company', -1)
+        if context.get('from_date'):
+            where &= line.date >= context['from_date']
+        if context.get('to_date'):
+            where &= line.date <= context['to_date']
+        # even ids for lines and odd ids for consolidated parts
+        return line.join(move,
+            condition=getattr(line, move_field) == move.id
+            ).select(
+                (line.id * 2).as_('id'),
+                move.company.as_('company'),
+                line.account.as_('account'),
+                getattr(move, location_field).as_('location'),
+                move.product.as_('product'),
+                line.date.as_('date'),
+                line.debit.as_('debit'),
+                line.credit.as_('credit'),
+                where=where)
+
+    @classmethod
+    def _consolidated_lines_query(cls):
+        pool = Pool()
+        AnalyticLine = pool.get('analytic_account.line')
+        LineStockMove = pool.get('analytic_account.line.stock_move')
+        Move = pool.get('stock.move')
+        context = Transaction().context
+
+        part = LineStockMove.__table__()
+        line = AnalyticLine.__table__()
+        move = Move.__table__()
+        where = move.company == context.get('company', -1)
+        if context.get('from_date'):
+            where &= line.date >= context['from_date']
+        if context.get('to_date'):
+            where &= line.date <= context['to_date']
+        return part.join(line, condition=part.line == line.id
+            ).join(move, condition=part.move == move.id
+            ).select(
+                (part.id * 2 + 1).as_('id'),
+                move.company.as_('company'),
+                line.account.as_('account'),
+                Case((part.type == 'income', move.from_location),
+                    else_=move.to_location).as_('location'),
+                move.product.as_('product'),
+                line.date.as_('date'),
+                part.debit.as_('debit'),
+                part.credit.as_('credit'),
+                where=where)
+
+
+class AnalyticFlowContext(ModelView):
+    'Stock Analytic Flow Context'
+    __name__ = 'stock.reporting.analytic_flow.context'
+    company = fields.Many2One('company.company', 'Company', required=True)
+    from_date = fields.Date('From Date',
+        domain=[
+            If(Eval('to_date') & Eval('from_date'),
+                ('from_date', '<=', Eval('to_date')),
+                ()),
+            ])
+    to_date = fields.Date('To Date',
+        domain=[
+            If(Eval('from_date') & Eval('to_date'),
+                ('to_date', '>=', Eval('from_date')),
+                ()),
+            ])
+    period = fields.Selection([
+            ('year', 'Year'),
+            ('month', 'Month'),
+            ('day', 'Day'),
+            ], 'Period', required=True)
+
+    @staticmethod
+    def default_company():
+        return Transaction().context.get('company')
+
+    @staticmethod
+    def default_from_date():
+        return Transaction().context.get('from_date')
+
+    @staticmethod
+    def default_to_date():
+        return Transaction().context.get('to_date')
+
+    @staticmethod
+    def default_period():
+        return Transaction().context.get('period', 'month')
@@ -0,0 +1,221 @@
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+'''
+Benchmark of the analytic lines created when stock moves are done.
+
+It creates a company with some locations configured with analytic accounts
+and some moves in different currencies and UoMs, then it measures the wall
+time, the number of SQL queries and the peak memory of Move.do for each
+scale. Every scale runs in its own transaction which is rolled back.
+
+It uses the same database settings as the tests (TRYTOND_DATABASE_URI and
+DB_NAME environment variables), so it can be run against SQLite or a local
+PostgreSQL:
+
+    python -m trytond.modules.analytic_stock.tests.benchmark \\
+        --scales 1000 10000 100000 --save baseline.json
+
+    python -m trytond.modules.analytic_stock.tests.benchmark \\
+        --scales 1000 10000 100000 --compare baseline.json
+'''
+import argparse
+import datetime
+import json
+import random
+import sys
+import time
+import tracemalloc
+from decimal import Decimal
+
+from trytond.pool import Pool
+from trytond.tests.test_tryton import (
+    activate_module, CONTEXT, DB_NAME, USER)
+from trytond.transaction import Transaction
+
+from trytond.modules.analytic_stock.metrics import QueryCounter
+from trytond.modules.company.tests import create_company, set_company
+from trytond.modules.currency.tests import add_currency_rate, create_currency
+
+METRICS = ['time', 'queries', 'memory']
+
+
+def setup_data(company, n_locations, n_moves, seed=0):
+    '''
+    Create the locations with analytic accounts and the draft moves.
+    '''
+    pool = Pool()
+    AnalyticAccount = pool.get('analytic_account.account')
+    Location = pool.get('stock.location')
+    Move = pool.get('stock.move')
+    Template = pool.get('product.template')
+    Uom = pool.get('product.uom')
+
+    rng = random.Random(seed)
+    today = datetime.date.today()
+
+    eur = create_currency('eur')
+    add_currency_rate(eur, Decimal('1.1'))
+    gbp = create_currency('gbp')
+    add_currency_rate(gbp, Decimal('0.85'))
+    currencies = [company.currency, eur, gbp]
+
+    unit, = Uom.search([('name', '=', 'Unit')])
+    units = Uom.search([('category', '=', unit.category.id)])
+    template, = Template.create([{
+                'name': 'Benchmark',
+                'type': 'goods',
+                'list_price': Decimal(10),
+                'cost_price_method': 'fixed',
+                'default_uom': unit.id,
+                'products': [('create', [{}])],
+                }])
+    product, = template.products
+
+    supplier, = Location.search([('code', '=', 'SUP')])
+    customer, = Location.search([('code', '=', 'CUS')])
+    storage, = Location.search([('code', '=', 'STO')])
+
+    root, = AnalyticAccount.create([{
+                'name': 'Benchmark',
+                'type': 'root',
+                }])
+    accounts = AnalyticAccount.create([{
+                'name': 'Benchmark %s' % i,
+                'type': 'normal',
+                'root': root.id,
+                'parent': root.id,
+                } for i in range(n_locations + 1)])
+    locations = Location.create([{
+                'name': 'Benchmark %s' % i,
+                'type': 'storage',
+                'parent': storage.id,
+                } for i in range(n_locations)])
+    for location, account in zip(locations + [supplier, customer],
+            accounts + [accounts[-1]]):
+        Location.write([location], {
+                'companies': [('create', [{
+                                'analytic_accounts': [('create', [{
+                                                'root': root.id,
+                                                'account': account.id,
+                                                }])],
+                                }])],
+                })
+
+    to_create = []
+    for i in range(n_moves):
+        location = rng.choice(locations)
+        kind = rng.random()
+        if kind < 0.4:
+            from_location, to_location = supplier, location
+        elif kind < 0.8:
+            from_location, to_location = location, customer
+        else:
+            from_location, to_location = location, rng.choice(locations)
+        to_create.append({
+                'product': product.id,
+                'unit': rng.choice(units).id,
+                'quantity': rng.randint(1, 100),
+                'from_location': from_location.id,
+                'to_location': to_location.id,
+                'planned_date': today,
+                'effective_date': today,
+                'company': company.id,
+                # zero unit price uses the cost price
+                'unit_price': Decimal(rng.choice([0, 1, 5, 12])),
+                'currency': rng.choice(currencies).id,
+                'cost_price': Decimal(3),
+                })
+    return Move.create(to_create)
+
+
+def run(n_moves, n_locations, seed=0):
+    '''
+    Return the metrics of Move.do for n_moves.
+    '''
+    with Transaction().start(DB_NAME, USER, context=CONTEXT) as transaction:
+        try:
+            pool = Pool()
+            Move = pool.get('stock.move')
+
+            company = create_company()
+            with set_company(company):
+                moves = setup_data(company, n_locations, n_moves, seed=seed)
+                moves = Move.browse([m.id for m in moves])
+
+                tracemalloc.start()
+                start = time.perf_counter()
+                with QueryCounter() as counter:
+                    Move.do(moves)
+                elapsed = time.perf_counter() - start
+                _, peak = tracemalloc.get_traced_memory()
+                tracemalloc.stop()
+        finally:
+            transaction.rollback()
+    return {
+        'time': elapsed,
+        'queries': counter.count,
+        'memory': peak,
+        }
+
+
+def compare(results, baseline, tolerance):
+    '''
+    Return the list of regressions of results against baseline.
+    '''
+    regressions = []
+    for scale, metrics in results.items():
+        if scale not in baseline:
+            continue
+        for name in METRICS:
+            reference = baseline[scale][name]
+            if reference and metrics[name] > reference * (1 + tolerance):
+                regressions.append((scale, name, reference, metrics[name]))
+    return regressions
+
+
+def main(arguments=None):
+    parser = argparse.ArgumentParser(
+        description='Benchmark analytic_stock done moves')
+    parser.add_argument('--scales', type=int, nargs='+',
+        default=[1000, 10000, 100000],
+        help='number of moves of each run')
+    parser.add_argument('--locations', type=int, default=50,
+        help='number of locations with analytic accounts')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--save', metavar='FILE',
+        help='save the results as baseline')
+    parser.add_argument('--compare', metavar='FILE',
+        help='compare the results with the baseline')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+        help='allowed relative increase before flagging a regression')
+    options = parser.parse_args(arguments)
+
+    activate_module('analytic_stock')
+
+    results = {}
+    print('%10s %12s %10s %14s' % ('moves', 'time (s)', 'queries',
+            'memory (KiB)'))
+    for scale in options.scales:
+        metrics = run(scale, options.locations, seed=options.seed)
+        results[str(scale)] = metrics
+        print('%10s %12.3f %10s %14.0f' % (scale, metrics['time'],
+                metrics['queries'], metrics['memory'] / 1024))
+
+    if options.save:
+        with open(options.save, 'w') as fp:
+            json.dump(results, fp, indent=4, sort_keys=True)
+
+    if options.compare:
+        with open(options.compare) as fp:
+            baseline = json.load(fp)
+        regressions = compare(results, baseline, options.tolerance)
+        for scale, name, reference, value in regressions:
+            print('Regression on %s moves: %s %s -> %s' % (
+                    scale, name, reference, value))
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
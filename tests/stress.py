@@ -0,0 +1,224 @@
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+'''
+Stress test of concurrent stock moves done with analytic lines.
+
+It creates a company with locations configured with analytic accounts and
+draft moves split in batches, commits them, then runs workers which do the
+batches concurrently, each batch in its own transaction like operators
+validating shipments at the same time. The transactions failing with a
+database operational error are retried.
+It reports the throughput, the p50 and p99 latencies of the batches and the
+number of deadlocks, serialization failures, lock timeouts and retries.
+
+The data is committed so it must be run against a disposable PostgreSQL
+database, using the same settings as the tests (TRYTOND_DATABASE_URI and
+DB_NAME environment variables):
+
+    python -m trytond.modules.analytic_stock.tests.stress \\
+        --workers 8 --batches 20 --batch-size 50
+'''
+import argparse
+import json
+import math
+import queue
+import sys
+import threading
+import time
+
+from trytond import backend
+from trytond.pool import Pool
+from trytond.tests.test_tryton import (
+    activate_module, CONTEXT, DB_NAME, USER)
+from trytond.transaction import Transaction
+
+from trytond.modules.analytic_stock.tests.benchmark import setup_data
+from trytond.modules.company.tests import create_company, set_company
+
+# PostgreSQL error codes
+DEADLOCK = '40P01'
+SERIALIZATION = '40001'
+LOCK_NOT_AVAILABLE = '55P03'
+
+
+def setup(options):
+    '''
+    Create and commit the company and the draft moves.
+    Return the company id and the batches of move ids.
+    '''
+    with Transaction().start(DB_NAME, USER, context=CONTEXT):
+        company = create_company()
+        company.analytic_stock_posting = options.posting
+        company.analytic_stock_consolidate = options.consolidate
+        company.save()
+        with set_company(company):
+            moves = setup_data(company, options.locations,
+                options.workers * options.batches * options.batch_size,
+                seed=options.seed)
+        ids = [m.id for m in moves]
+        company_id = company.id
+    batches = [ids[i:i + options.batch_size]
+        for i in range(0, len(ids), options.batch_size)]
+    return company_id, batches
+
+
+class Stats(object):
+    '''
+    Statistics of the batches shared by the workers.
+    '''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latencies = []
+        self.moves = 0
+        self.retries = 0
+        self.failures = 0
+        self.errors = {
+            DEADLOCK: 0,
+            SERIALIZATION: 0,
+            LOCK_NOT_AVAILABLE: 0,
+            None: 0,
+            }
+
+    def error(self, exception):
+        # psycopg 3 exposes sqlstate and psycopg2 pgcode
+        code = getattr(exception, 'sqlstate', None)
+        if code is None:
+            code = getattr(exception, 'pgcode', None)
+        with self._lock:
+            if code not in self.errors:
+                code = None
+            self.errors[code] += 1
+
+    def done(self, latency, moves, retries, failed=False):
+        with self._lock:
+            self.latencies.append(latency)
+            self.retries += retries
+            if failed:
+                self.failures += 1
+            else:
+                self.moves += moves
+
+
+def worker(company_id, batches, stats, retries):
+    '''
+    Do the batches of moves until there is none left.
+    '''
+    context = CONTEXT.copy()
+    context['company'] = company_id
+    while True:
+        try:
+            ids = batches.get_nowait()
+        except queue.Empty:
+            return
+        start = time.perf_counter()
+        count = 0
+        while True:
+            try:
+                with Transaction().start(DB_NAME, USER, context=context):
+                    Move = Pool().get('stock.move')
+                    Move.do(Move.browse(ids))
+            except backend.DatabaseOperationalError as exception:
+                stats.error(exception)
+                if count < retries:
+                    count += 1
+                    time.sleep(0.02 * count)
+                    continue
+                stats.done(time.perf_counter() - start, len(ids), count,
+                    failed=True)
+            else:
+                stats.done(time.perf_counter() - start, len(ids), count)
+            break
+
+
+def percentile(values, percent):
+    'Return the nearest-rank percentile of values'
+    if not values:
+        return 0.
+    values = sorted(values)
+    index = max(math.ceil(percent / 100. * len(values)) - 1, 0)
+    return values[min(index, len(values) - 1)]
+
+
+def run(options):
+    '''
+    Return the results of the concurrent run.
+    '''
+    company_id, batches = setup(options)
+    to_do = queue.Queue()
+    for batch in batches:
+        to_do.put(batch)
+
+    stats = Stats()
+    threads = [threading.Thread(target=worker,
+            args=(company_id, to_do, stats, options.retries))
+        for _ in range(options.workers)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    return {
+        'workers': options.workers,
+        'batches': len(stats.latencies),
+        'moves': stats.moves,
+        'time': elapsed,
+        'throughput': stats.moves / elapsed if elapsed else 0.,
+        'p50': percentile(stats.latencies, 50),
+        'p99': percentile(stats.latencies, 99),
+        'deadlocks': stats.errors[DEADLOCK],
+        'serialization_failures': stats.errors[SERIALIZATION],
+        'lock_timeouts': stats.errors[LOCK_NOT_AVAILABLE],
+        'other_errors': stats.errors[None],
+        'retries': stats.retries,
+        'failures': stats.failures,
+        }
+
+
+def main(arguments=None):
+    parser = argparse.ArgumentParser(
+        description='Stress test concurrent analytic_stock done moves')
+    parser.add_argument('--workers', type=int, default=8,
+        help='number of concurrent transactions')
+    parser.add_argument('--batches', type=int, default=20,
+        help='number of batches by worker')
+    parser.add_argument('--batch-size', type=int, default=50,
+        help='number of moves by batch')
+    parser.add_argument('--locations', type=int, default=50,
+        help='number of locations with analytic accounts')
+    parser.add_argument('--posting', choices=['immediate', 'deferred'],
+        default='immediate', help='analytic stock posting of the company')
+    parser.add_argument('--consolidate', action='store_true',
+        help='consolidate the analytic lines by shipment')
+    parser.add_argument('--retries', type=int, default=5,
+        help='number of retries of a failed batch')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--save', metavar='FILE',
+        help='save the results as JSON')
+    options = parser.parse_args(arguments)
+
+    if backend.name != 'postgresql':
+        parser.error('the stress test requires PostgreSQL')
+
+    activate_module('analytic_stock')
+
+    results = run(options)
+    for name in ['workers', 'batches', 'moves', 'retries', 'failures',
+            'deadlocks', 'serialization_failures', 'lock_timeouts',
+            'other_errors']:
+        print('%-24s %10s' % (name, results[name]))
+    print('%-24s %10.3f' % ('time (s)', results['time']))
+    print('%-24s %10.1f' % ('throughput (moves/s)', results['throughput']))
+    print('%-24s %10.3f' % ('p50 latency (s)', results['p50']))
+    print('%-24s %10.3f' % ('p99 latency (s)', results['p99']))
+
+    if options.save:
+        with open(options.save, 'w') as fp:
+            json.dump(results, fp, indent=4, sort_keys=True)
+    return 1 if results['failures'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
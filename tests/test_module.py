@@ -2,20 +2,123 @@
 # This file is part of Tryton.  The COPYRIGHT file at the top level of
 # this repository contains the full copyright notices and license terms.
 
+import csv
 import datetime
+import io
+import unittest
 from decimal import Decimal
 
-from trytond.tests.test_tryton import ModuleTestCase, with_transaction
+from trytond import backend, config
+from trytond.tests.test_tryton import (
+    ModuleTestCase, with_transaction, DB_NAME)
 from trytond.pool import Pool
+from trytond.transaction import Transaction
 
 from trytond.modules.company.tests import create_company, set_company, CompanyTestMixin
 from trytond.modules.account.tests import create_chart
+from trytond.modules.currency.tests import create_currency, add_currency_rate
+from trytond.modules.analytic_stock import parallel
+from trytond.modules.analytic_stock.memo import AnalyticMemo
+from trytond.modules.analytic_stock.metrics import QueryCounter, registry
 
 
 class AnalyticStockTestCase(CompanyTestMixin, ModuleTestCase):
     'Test AnalyticStock module'
     module = 'analytic_stock'
 
+    def create_analytic_setup(self, company):
+        '''
+        Create a product and set analytic accounts to supplier, customer and
+        storage locations.
+        '''
+        pool = Pool()
+        Template = pool.get('product.template')
+        Uom = pool.get('product.uom')
+        Location = pool.get('stock.location')
+        AnalyticAccount = pool.get('analytic_account.account')
+
+        unit, = Uom.search([('name', '=', 'Unit')])
+        template, = Template.create([{
+                    'name': 'Product',
+                    'type': 'goods',
+                    'list_price': Decimal(4),
+                    'cost_price_method': 'fixed',
+                    'default_uom': unit.id,
+                    'products': [
+                        ('create', [{}]),
+                        ],
+                    }])
+        product, = template.products
+
+        supplier, = Location.search([('code', '=', 'SUP')])
+        customer, = Location.search([('code', '=', 'CUS')])
+        storage, = Location.search([('code', '=', 'STO')])
+
+        root, = AnalyticAccount.create([{
+                    'name': 'Root',
+                    'code': 'R',
+                    'type': 'root',
+                    }])
+        external, internal = AnalyticAccount.create([{
+                    'name': 'External',
+                    'code': 'E',
+                    'type': 'normal',
+                    'root': root.id,
+                    'parent': root.id,
+                    }, {
+                    'name': 'Internal',
+                    'code': 'I',
+                    'type': 'normal',
+                    'root': root.id,
+                    'parent': root.id,
+                    }])
+        for locations, account in (
+                ([supplier, customer], external),
+                ([storage], internal),
+                ):
+            Location.write(locations, {
+                    'companies': [
+                        ('create', [{
+                                    'analytic_accounts': [
+                                        ('create', [{
+                                                    'root': root.id,
+                                                    'account': account.id,
+                                                    }]),
+                                        ],
+                                    }]),
+                        ],
+                    })
+        return {
+            'product': product,
+            'unit': unit,
+            'supplier': supplier,
+            'customer': customer,
+            'storage': storage,
+            'external': external,
+            'internal': internal,
+            }
+
+    def create_move(self, company, setup, from_location, to_location,
+            quantity=10, unit_price=Decimal(1), shipment=None):
+        pool = Pool()
+        Move = pool.get('stock.move')
+
+        today = datetime.date.today()
+        move, = Move.create([{
+                    'product': setup['product'].id,
+                    'unit': setup['unit'].id,
+                    'quantity': quantity,
+                    'from_location': setup[from_location].id,
+                    'to_location': setup[to_location].id,
+                    'planned_date': today,
+                    'effective_date': today,
+                    'company': company.id,
+                    'unit_price': unit_price,
+                    'currency': company.currency.id,
+                    'shipment': str(shipment) if shipment else None,
+                    }])
+        return move
+
     @with_transaction()
     def test0010move_analytic_accounts(self):
         '''
@@ -239,5 +342,632 @@ class AnalyticStockTestCase(CompanyTestMixin, ModuleTestCase):
                         for e in lc.analytic_accounts])
                 )
 
+    @with_transaction()
+    def test0020deferred_analytic_posting(self):
+        '''
+        Test deferred analytic posting of done moves.
+        '''
+        pool = Pool()
+        Move = pool.get('stock.move')
+
+        company = create_company()
+        company.analytic_stock_posting = 'deferred'
+        company.save()
+        with set_company(company):
+            create_chart(company)
+            setup = self.create_analytic_setup(company)
+            move = self.create_move(company, setup, 'supplier', 'storage')
+            Move.do([move])
+
+            self.assertTrue(move.analytic_pending)
+            self.assertFalse(move.expense_analytic_lines)
+            self.assertEqual(
+                Move.search([('analytic_pending', '=', True)]), [move])
+
+            Move.post_analytic_lines([move])
+            # a retried task must not duplicate the lines
+            Move.post_analytic_lines([move])
+            move = Move(move.id)
+
+            self.assertFalse(move.analytic_pending)
+            self.assertEqual(
+                [(l.account, l.credit) for l in move.expense_analytic_lines],
+                [(setup['internal'], Decimal('10.00'))])
+
+            other = self.create_move(company, setup, 'supplier', 'storage')
+            Move.do([other])
+            self.assertEqual(
+                Move.post_pending_analytic_lines(company=company), [])
+            other = Move(other.id)
+            self.assertFalse(other.analytic_pending)
+            self.assertEqual(len(other.expense_analytic_lines), 1)
+
+    @unittest.skipIf(DB_NAME == ':memory:',
+        'the processes can not share an in-memory database')
+    @with_transaction()
+    def test0025parallel_run(self):
+        '''
+        Test run of chunks of records in parallel processes.
+        '''
+        pool = Pool()
+        Location = pool.get('stock.location')
+
+        # the locations of the module data are committed
+        ids = [l.id for l in Location.search([])]
+        results, failures = parallel.run('stock.location', 'export_data',
+            ids, processes=2, chunk_size=2, fields_names=['id'])
+        self.assertEqual(failures, [])
+        self.assertEqual(len(results), (len(ids) + 1) // 2)
+        self.assertEqual(
+            sorted(r[0] for result in results for r in result),
+            sorted(ids))
+
+        results, failures = parallel.run('stock.location', 'missing', ids,
+            processes=2, chunk_size=2)
+        self.assertEqual(results, [])
+        self.assertEqual(
+            sorted(i for chunk, _ in failures for i in chunk), sorted(ids))
+
+    @with_transaction()
+    def test0030recompute_analytic_lines(self):
+        '''
+        Test recompute analytic lines of done moves.
+        '''
+        pool = Pool()
+        Move = pool.get('stock.move')
+        AnalyticLine = pool.get('analytic_account.line')
+
+        company = create_company()
+        with set_company(company):
+            create_chart(company)
+            setup = self.create_analytic_setup(company)
+            move = self.create_move(company, setup, 'supplier', 'storage')
+            Move.do([move])
+            self.assertEqual(len(move.income_analytic_lines), 1)
+            self.assertEqual(len(move.expense_analytic_lines), 1)
+
+            # nothing changed
+            self.assertEqual(
+                Move.recompute_analytic_lines(company), (0, 0, []))
+
+            AnalyticLine.delete(list(move.expense_analytic_lines))
+            # the new price is compensated with delta lines
+            Move.write([move], {'unit_price': Decimal(2)})
+            move = Move(move.id)
+            self.assertEqual(
+                sorted(l.debit for l in move.income_analytic_lines),
+                [Decimal('10.00'), Decimal('10.00')])
+            self.assertEqual(
+                [l.credit for l in move.expense_analytic_lines],
+                [Decimal('20.00')])
+
+            # the income lines are replaced by a single line
+            self.assertEqual(
+                Move.recompute_analytic_lines(company, chunk_size=1),
+                (2, 1, []))
+            move = Move(move.id)
+            self.assertEqual(
+                [l.debit for l in move.income_analytic_lines],
+                [Decimal('20.00')])
+            self.assertEqual(
+                [l.credit for l in move.expense_analytic_lines],
+                [Decimal('20.00')])
+
+            # the processes commit their chunks
+            with self.assertRaises(ValueError):
+                Move.recompute_analytic_lines(company, processes=2)
+
+    @with_transaction()
+    def test0035preview_analytic_lines(self):
+        '''
+        Test preview analytic lines of draft moves.
+        '''
+        pool = Pool()
+        Move = pool.get('stock.move')
+        AnalyticLine = pool.get('analytic_account.line')
+        Date = pool.get('ir.date')
+
+        company = create_company()
+        with set_company(company):
+            create_chart(company)
+            setup = self.create_analytic_setup(company)
+            moves = [
+                self.create_move(company, setup, 'supplier', 'storage'),
+                self.create_move(company, setup, 'supplier', 'storage',
+                    quantity=5),
+                ]
+
+            lines = list(Move.preview_analytic_lines(moves, chunk_size=1))
+            self.assertEqual(len(lines), 4)
+            self.assertEqual(set(l['date'] for l in lines), {Date.today()})
+            totals, count = Move.preview_analytic_totals(moves)
+            self.assertEqual(count, 4)
+            self.assertEqual(totals, {
+                    setup['external'].id: (Decimal('15.00'), Decimal(0)),
+                    setup['internal'].id: (Decimal(0), Decimal('15.00')),
+                    })
+            self.assertEqual(AnalyticLine.search([]), [])
+            self.assertEqual(set(m.state for m in moves), {'draft'})
+
+    @with_transaction()
+    def test0037export_stock_lines(self):
+        '''
+        Test export analytic lines of stock moves.
+        '''
+        pool = Pool()
+        Move = pool.get('stock.move')
+        AnalyticLine = pool.get('analytic_account.line')
+
+        company = create_company()
+        with set_company(company):
+            create_chart(company)
+            setup = self.create_analytic_setup(company)
+            move = self.create_move(company, setup, 'supplier', 'storage')
+            Move.do([move])
+
+            file = io.StringIO()
+            count, watermark = AnalyticLine.export_stock_lines(file,
+                company=company, chunk_size=1)
+            self.assertEqual(count, 2)
+            rows = list(csv.DictReader(io.StringIO(file.getvalue())))
+            self.assertEqual(
+                sorted((r['type'], r['move'], r['location']) for r in rows),
+                [('expense', str(move.id), str(setup['storage'].id)),
+                    ('income', str(move.id), str(setup['supplier'].id))])
+
+            # the lines at the watermark are exported again
+            file = io.StringIO()
+            count, _ = AnalyticLine.export_stock_lines(file,
+                since=watermark, overlap=datetime.timedelta(0))
+            self.assertEqual(count, 2)
+            self.assertEqual(
+                {r['line'] for r in csv.DictReader(
+                        io.StringIO(file.getvalue()))},
+                {r['line'] for r in rows})
+            count, _ = AnalyticLine.export_stock_lines(io.StringIO(),
+                since=watermark + datetime.timedelta(seconds=1),
+                overlap=datetime.timedelta(0))
+            self.assertEqual(count, 0)
+
+    @with_transaction()
+    def test0040metrics(self):
+        '''
+        Test metrics of analytic processing.
+        '''
+        pool = Pool()
+        Move = pool.get('stock.move')
+
+        company = create_company()
+        with set_company(company):
+            create_chart(company)
+            setup = self.create_analytic_setup(company)
+            move = self.create_move(company, setup, 'supplier', 'storage')
+
+            if not config.has_section('analytic_stock'):
+                config.add_section('analytic_stock')
+            config.set('analytic_stock', 'metrics', 'True')
+            registry.reset()
+            try:
+                Move.do([move])
+            finally:
+                config.set('analytic_stock', 'metrics', 'False')
+
+            metrics = registry.snapshot()
+            self.assertEqual(
+                set(metrics),
+                {'prefetch', 'accounts', 'amounts', 'lines', 'write'})
+            self.assertEqual(metrics['write']['lines'], 2)
+            self.assertEqual(metrics['amounts']['moves'], 1)
+            self.assertGreater(metrics['write']['queries'], 0)
+
+    @with_transaction()
+    def test0042analytic_amounts(self):
+        '''
+        Test analytic amounts match currency and UoM conversions.
+        '''
+        pool = Pool()
+        Move = pool.get('stock.move')
+        Currency = pool.get('currency.currency')
+        Uom = pool.get('product.uom')
+
+        company = create_company()
+        with set_company(company):
+            create_chart(company)
+            setup = self.create_analytic_setup(company)
+            eur = create_currency('eur')
+            add_currency_rate(eur, Decimal('1.3'))
+            dozen, = Uom.search([('name', '=', 'Dozen')])
+
+            foreign = self.create_move(company, setup, 'supplier', 'storage',
+                quantity=7, unit_price=Decimal('3.3333'))
+            Move.write([foreign], {'currency': eur.id})
+            cost = self.create_move(company, setup, 'storage', 'customer',
+                quantity=7, unit_price=Decimal(0))
+            Move.write([cost], {
+                    'unit': dozen.id,
+                    'cost_price': Decimal('1.2345'),
+                    })
+            foreign, cost = Move.browse([foreign.id, cost.id])
+
+            exp = Decimal(str(10.0 ** -company.currency.digits))
+            with Transaction().set_context(date=foreign.effective_date):
+                foreign_amount = Currency.compute(eur,
+                    Decimal('3.3333') * Decimal(7), company.currency)
+            cost_amount = Decimal('1.2345') * Decimal(str(
+                    Uom.compute_qty(dozen, 7, setup['unit'])))
+            expected = {
+                foreign.id: foreign_amount.quantize(exp),
+                cost.id: cost_amount.quantize(exp),
+                }
+            self.assertEqual(
+                Move._get_analytic_amounts([foreign, cost]), expected)
+            # memoized conversions give the same amounts
+            self.assertEqual(
+                Move._get_analytic_amounts([foreign, cost]), expected)
+
+    @with_transaction()
+    def test0043analytic_lines_queries(self):
+        '''
+        Test the queries to create analytic lines do not depend on the number
+        of moves.
+        '''
+        pool = Pool()
+        Move = pool.get('stock.move')
+
+        company = create_company()
+        with set_company(company):
+            create_chart(company)
+            setup = self.create_analytic_setup(company)
+            moves = [self.create_move(company, setup, 'supplier', 'storage')
+                for _ in range(31)]
+
+            # fill the caches of accounts
+            Move.create_analytic_lines(moves[:1])
+            counts = []
+            for sub_moves in [moves[1:11], moves[11:31]]:
+                sub_moves = Move.browse([m.id for m in sub_moves])
+                with QueryCounter() as counter:
+                    Move.create_analytic_lines(sub_moves)
+                counts.append(counter.count)
+            self.assertEqual(counts[0], counts[1])
+
+    @with_transaction()
+    def test0045analytic_memo(self):
+        '''
+        Test memo of currency rates and UoM conversions.
+        '''
+        memo = AnalyticMemo.get()
+        self.assertIs(AnalyticMemo.get(), memo)
+
+        calls = []
+
+        def compute():
+            calls.append(1)
+            return Decimal(1), Decimal(2)
+
+        for _ in range(3):
+            self.assertEqual(memo.rate(1, 2, None, compute),
+                (Decimal(1), Decimal(2)))
+        self.assertEqual(len(calls), 1)
+        self.assertEqual((memo.hits, memo.misses), (2, 1))
+        self.assertAlmostEqual(memo.hit_rate, 2 / 3)
+
+        # a new rate invalidates the memoized rates
+        currency = create_currency('cu1')
+        add_currency_rate(currency, Decimal(1))
+        self.assertEqual(memo.rates, {})
+
+    @with_transaction()
+    def test0050analytic_flow(self):
+        '''
+        Test the analytic flow report.
+        '''
+        pool = Pool()
+        Move = pool.get('stock.move')
+        AnalyticFlow = pool.get('stock.reporting.analytic_flow')
+
+        company = create_company()
+        with set_company(company):
+            create_chart(company)
+            setup = self.create_analytic_setup(company)
+            moves = [
+                self.create_move(company, setup, 'supplier', 'storage'),
+                self.create_move(company, setup, 'supplier', 'storage',
+                    quantity=5),
+                ]
+            Move.do(moves)
+
+            with Transaction().set_context(period='day'):
+                flows = AnalyticFlow.search([], order=[('debit', 'ASC')])
+            self.assertEqual([(f.account, f.location, f.debit, f.credit)
+                    for f in flows], [
+                    (setup['internal'], setup['storage'],
+                        Decimal(0), Decimal(15)),
+                    (setup['external'], setup['supplier'],
+                        Decimal(15), Decimal(0)),
+                    ])
+
+    @with_transaction()
+    def test0060analytic_line_indexes(self):
+        '''
+        Test the indexes of stock analytic lines are created.
+        '''
+        pool = Pool()
+        AnalyticLine = pool.get('analytic_account.line')
+
+        table_h = backend.TableHandler(AnalyticLine)
+        names = set()
+        for index in AnalyticLine._sql_indexes:
+            if 'stock_move' not in str(index.options.get('where', '')):
+                continue
+            translator = table_h.index_translator_for(index)
+            name, _, _ = translator.definition(index)
+            name = '_'.join([table_h.table_name, name])
+            names.add('idx_' + table_h.convert_name(name, reserved=4))
+        self.assertEqual(len(names), 4)
+        self.assertLessEqual(names, set(table_h._indexes))
+
+    @with_transaction()
+    def test0070analytic_delta_lines(self):
+        '''
+        Test compensating analytic lines on price change and cancel.
+        '''
+        pool = Pool()
+        Move = pool.get('stock.move')
+
+        def balance(lines):
+            return sum(l.debit - l.credit for l in lines)
+
+        company = create_company()
+        with set_company(company):
+            create_chart(company)
+            setup = self.create_analytic_setup(company)
+            move = self.create_move(company, setup, 'supplier', 'storage')
+            Move.do([move])
+
+            Move.write([move], {'unit_price': Decimal('1.5')})
+            move = Move(move.id)
+            self.assertEqual(len(move.income_analytic_lines), 2)
+            self.assertEqual(
+                balance(move.income_analytic_lines), Decimal(15))
+            self.assertEqual(
+                balance(move.expense_analytic_lines), Decimal(-15))
+
+            Move.cancel([move])
+            move = Move(move.id)
+            self.assertEqual(len(move.income_analytic_lines), 3)
+            self.assertEqual(balance(move.income_analytic_lines), 0)
+            self.assertEqual(balance(move.expense_analytic_lines), 0)
+
+    @with_transaction()
+    def test0080consolidated_analytic_lines(self):
+        '''
+        Test analytic lines consolidated by shipment.
+        '''
+        pool = Pool()
+        Move = pool.get('stock.move')
+        AnalyticLine = pool.get('analytic_account.line')
+        Party = pool.get('party.party')
+        Location = pool.get('stock.location')
+        ShipmentOut = pool.get('stock.shipment.out')
+
+        company = create_company()
+        company.analytic_stock_consolidate = True
+        company.save()
+        with set_company(company):
+            create_chart(company)
+            setup = self.create_analytic_setup(company)
+            warehouse, = Location.search([('code', '=', 'WH')])
+            customer, = Party.create([{
+                        'name': 'Customer',
+                        'addresses': [('create', [{}])],
+                        }])
+            shipment, = ShipmentOut.create([{
+                        'customer': customer.id,
+                        'delivery_address': customer.addresses[0].id,
+                        'warehouse': warehouse.id,
+                        'company': company.id,
+                        }])
+            moves = [
+                self.create_move(company, setup, 'storage', 'customer',
+                    shipment=shipment),
+                self.create_move(company, setup, 'storage', 'customer',
+                    quantity=5, shipment=shipment),
+                ]
+            # the preview consolidates the shipment like do
+            preview = list(Move.preview_analytic_lines(moves, chunk_size=1))
+            self.assertEqual(len(preview), 2)
+            self.assertEqual(
+                sorted(len(l['stock_moves'][0][1]) for l in preview), [2, 2])
+            Move.do(moves)
+
+            for move in moves:
+                self.assertFalse(move.income_analytic_lines)
+                self.assertFalse(move.expense_analytic_lines)
+                self.assertEqual(len(move.consolidated_analytic_lines), 2)
+            income_line, = {p.line
+                for p in moves[0].consolidated_analytic_lines
+                if p.type == 'income'}
+            self.assertEqual(income_line.debit, Decimal(15))
+            self.assertEqual(income_line.account, setup['internal'])
+            self.assertEqual(income_line.party, customer)
+            self.assertEqual(
+                sorted(p.debit for p in income_line.stock_moves),
+                [Decimal(5), Decimal(10)])
+
+            # cancel one move of the shipment
+            Move.cancel(moves[1:])
+            move = Move(moves[1].id)
+            self.assertEqual(
+                [l.credit for l in move.income_analytic_lines], [Decimal(5)])
+            self.assertEqual(
+                [l.debit for l in move.expense_analytic_lines], [Decimal(5)])
+
+            # deleting the cancelled move removes its part of the shipment
+            Move.delete([move])
+            income_line = AnalyticLine(income_line.id)
+            self.assertEqual(income_line.debit, Decimal(10))
+            self.assertEqual(
+                [p.debit for p in income_line.stock_moves], [Decimal(10)])
+
+            # the recomputed lines are consolidated like the posted ones
+            move = Move(moves[0].id)
+            AnalyticLine.delete(
+                list({p.line for p in move.consolidated_analytic_lines}))
+            self.assertEqual(
+                Move.recompute_analytic_lines(company), (0, 2, []))
+            move = Move(moves[0].id)
+            self.assertFalse(move.income_analytic_lines)
+            self.assertFalse(move.expense_analytic_lines)
+            self.assertEqual(len(move.consolidated_analytic_lines), 2)
+
+    @with_transaction()
+    def test0090location_analytic_accounts(self):
+        '''
+        Test location analytic accounts are maintained.
+        '''
+        pool = Pool()
+        Location = pool.get('stock.location')
+        LocationAnalyticAccount = pool.get('stock.location.analytic_account')
+        LocationCompany = pool.get('stock.location.company')
+
+        company = create_company()
+        with set_company(company):
+            create_chart(company)
+            setup = self.create_analytic_setup(company)
+
+            self.assertEqual(
+                LocationAnalyticAccount.get_accounts([company.id]),
+                {company.id: {
+                        setup['supplier'].id: (setup['external'].id,),
+                        setup['customer'].id: (setup['external'].id,),
+                        setup['storage'].id: (setup['internal'].id,),
+                        }})
+
+            LocationCompany.delete(LocationCompany.search([
+                        ('location', '=', setup['customer'].id),
+                        ]))
+            self.assertNotIn(setup['customer'].id,
+                LocationAnalyticAccount.get_accounts(
+                    [company.id])[company.id])
+
+            # child locations inherit from their nearest configured ancestor
+            bin_, = Location.create([{
+                        'name': 'Bin',
+                        'type': 'storage',
+                        'parent': setup['storage'].id,
+                        }])
+            sub_bin, = Location.create([{
+                        'name': 'Sub Bin',
+                        'type': 'storage',
+                        'parent': bin_.id,
+                        }])
+            accounts = LocationAnalyticAccount.get_accounts(
+                [company.id])[company.id]
+            self.assertEqual(accounts[sub_bin.id], (setup['internal'].id,))
+            external = setup['external']
+            Location.write([bin_], {
+                    'companies': [
+                        ('create', [{
+                                    'analytic_accounts': [
+                                        ('create', [{
+                                                    'root': external.root.id,
+                                                    'account': external.id,
+                                                    }]),
+                                        ],
+                                    }]),
+                        ],
+                    })
+            accounts = LocationAnalyticAccount.get_accounts(
+                [company.id])[company.id]
+            self.assertEqual(accounts[sub_bin.id], (external.id,))
+            self.assertEqual(
+                accounts[setup['storage'].id], (setup['internal'].id,))
+
+            self.assertIn('storage', Location.enabled_location_types())
+            self.assertEqual(Location.enabled_location_types(),
+                Location.enabled_location_types())
+
+    @with_transaction()
+    def test0100period_analytic_cache(self):
+        '''
+        Test analytic cache of closed stock periods.
+        '''
+        pool = Pool()
+        Move = pool.get('stock.move')
+        Period = pool.get('stock.period')
+        AnalyticCache = pool.get('stock.period.analytic_cache')
+        AnalyticLine = pool.get('analytic_account.line')
+
+        company = create_company()
+        with set_company(company):
+            create_chart(company)
+            setup = self.create_analytic_setup(company)
+            today = datetime.date.today()
+            move = self.create_move(company, setup, 'supplier', 'storage')
+            Move.write([move], {
+                    'effective_date': today - datetime.timedelta(days=10),
+                    })
+            Move.do([move])
+
+            # a move pending of deferred posting is posted on close
+            company.analytic_stock_posting = 'deferred'
+            company.save()
+            pending = self.create_move(company, setup, 'supplier', 'storage')
+            Move.write([pending], {
+                    'effective_date': today - datetime.timedelta(days=8),
+                    })
+            Move.do([pending])
+            company.analytic_stock_posting = 'immediate'
+            company.save()
+
+            period, = Period.create([{
+                        'date': today - datetime.timedelta(days=5),
+                        'company': company.id,
+                        }])
+            Period.close([period])
+            pending = Move(pending.id)
+            self.assertFalse(pending.analytic_pending)
+            key = (setup['internal'].id, setup['storage'].id,
+                setup['product'].id)
+            self.assertEqual(
+                [(c.account.id, c.location.id, c.product.id, c.credit)
+                    for c in period.analytic_caches
+                    if c.account == setup['internal']],
+                [key + (Decimal(20),)])
+
+            # the moves of closed periods are not recomputed
+            expense_lines = list(pending.expense_analytic_lines)
+            AnalyticLine.delete(expense_lines)
+            self.assertEqual(
+                Move.recompute_analytic_lines(company), (0, 0, []))
+
+            # a period without cache is not used as snapshot
+            AnalyticCache.delete(list(period.analytic_caches))
+            balances = AnalyticCache.get_balances(company)
+            self.assertEqual(balances[key], (Decimal(0), Decimal(10)))
+
+            # the backfill recomputes the moves of closed periods and
+            # rebuilds their caches
+            self.assertEqual(
+                Move.recompute_analytic_lines(company, closed_periods=True),
+                (0, len(expense_lines), []))
+            period = Period(period.id)
+            self.assertEqual(
+                [c.credit for c in period.analytic_caches
+                    if c.account == setup['internal']],
+                [Decimal(20)])
+
+            move = self.create_move(company, setup, 'supplier', 'storage')
+            Move.do([move])
+            balances = AnalyticCache.get_balances(company)
+            self.assertEqual(balances[key], (Decimal(0), Decimal(30)))
+            balances = AnalyticCache.get_balances(company,
+                date=today - datetime.timedelta(days=1))
+            self.assertEqual(balances[key], (Decimal(0), Decimal(20)))
+
+            Period.draft([period])
+            self.assertEqual(AnalyticCache.search([]), [])
+
 
 del ModuleTestCase